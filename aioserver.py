@@ -0,0 +1,154 @@
+import logging
+import socket
+from typing import Optional
+
+from aiohttp import web
+
+import db_async
+from bulk import BulkImport, detect_format
+from config import FLASK_HOST, FLASK_PORT, INGEST_KEEPALIVE_TIMEOUT
+from db import init_db, start_backfills
+from ingest import enqueue_event, is_duplicate, start_writer, stop_writer, write_event
+from metrics import BULK_EVENTS, CONTENT_TYPE, POSTBACKS, POSTBACK_SECONDS, render
+import startup
+
+logger = logging.getLogger(__name__)
+
+_OK_BODY = b'{"status":"ok"}'
+_DUPLICATE_BODY = b'{"status":"duplicate"}'
+
+
+async def _accept(request: web.Request, event_type: str) -> web.Response:
+    telegram_user_id = int(request.match_info["telegram_user_id"])
+    player_id = request.query.get('player_id')
+    btag = request.query.get('btag')
+    campaign_id = request.query.get('campaign_id')
+    with POSTBACK_SECONDS.time(event_type):
+        if is_duplicate(telegram_user_id, event_type, player_id):
+            POSTBACKS.inc(event_type, "duplicate")
+            return web.Response(body=_DUPLICATE_BODY, content_type="application/json")
+        if not enqueue_event(telegram_user_id, event_type, player_id, btag, campaign_id):
+            # Writer not running or queue full: write on the db pool, never on the event loop
+            try:
+                await db_async.run(write_event, telegram_user_id, event_type, player_id, btag, campaign_id)
+            except Exception:
+                POSTBACKS.inc(event_type, "error")
+                raise
+        POSTBACKS.inc(event_type, "ok")
+        return web.Response(body=_OK_BODY, content_type="application/json")
+
+
+async def registration(request: web.Request) -> web.Response:
+    return await _accept(request, 'registration')
+
+
+async def first_dep(request: web.Request) -> web.Response:
+    return await _accept(request, 'first_dep')
+
+
+async def bulk(request: web.Request) -> web.Response:
+    batch = BulkImport(detect_format(request.content_type, request.query.get('format')))
+    async for line in request.content:
+        batch.feed(line)
+        if batch.ready():
+            await db_async.run(batch.flush)
+    await db_async.run(batch.flush)
+    summary = batch.summary()
+    for status in ("accepted", "duplicate", "rejected"):
+        BULK_EVENTS.inc(status, amount=summary[status])
+    return web.json_response(summary)
+
+
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), headers={"Content-Type": CONTENT_TYPE})
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_route('GET', r'/{telegram_user_id:\d+}/registration', registration)
+    app.router.add_route('POST', r'/{telegram_user_id:\d+}/registration', registration)
+    app.router.add_route('GET', r'/{telegram_user_id:\d+}/firstdep', first_dep)
+    app.router.add_route('POST', r'/{telegram_user_id:\d+}/firstdep', first_dep)
+    app.router.add_route('POST', '/bulk', bulk)
+    app.router.add_route('GET', '/metrics', metrics)
+    return app
+
+
+async def start_server(host: str = FLASK_HOST, port: int = FLASK_PORT) -> web.AppRunner:
+    """Starts the postback server on the running event loop; stop it with runner.cleanup()"""
+    init_db()
+    start_writer()
+    runner = web.AppRunner(create_app(), access_log=None, keepalive_timeout=INGEST_KEEPALIVE_TIMEOUT)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    startup.mark("listening")
+    logger.info(f"Сервер постбеков (aiohttp) слушает {host}:{port}")
+    start_backfills()
+    return runner
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Serves only /metrics, for processes that don't run the postback server"""
+    app = web.Application()
+    app.router.add_route('GET', '/metrics', metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики процесса доступны на {host}:{port}/metrics")
+    return runner
+
+
+async def _report_startup(app: web.Application) -> None:
+    startup.mark("listening")
+    startup.report()
+
+
+async def _start_backfills(app: web.Application) -> None:
+    start_backfills()
+
+
+def run_standalone(
+    sock: Optional[socket.socket] = None, backfills: bool = True, metrics_port: Optional[int] = None,
+) -> None:
+    """
+    Runs the postback server as a separate process with its own event loop, on FLASK_HOST:FLASK_PORT
+    or on an already listening socket shared with other worker processes. Stops on SIGTERM/SIGINT
+    after flushing the queued events. With backfills, pending data migrations run in the background.
+    A worker on a shared socket gets metrics_port: a scrape of the shared port reaches any of the
+    workers, so each one also serves its own /metrics there.
+    """
+    init_db()
+    start_writer()
+    address = {"sock": sock} if sock is not None else {"host": FLASK_HOST, "port": FLASK_PORT}
+    where = f"общем сокете {sock.getsockname()}" if sock is not None else f"{FLASK_HOST}:{FLASK_PORT}"
+    logger.info(f"Сервер постбеков (aiohttp) слушает {where}")
+    app = create_app()
+    app.on_startup.append(_report_startup)
+    if backfills:
+        app.on_startup.append(_start_backfills)
+    if metrics_port:
+        async def metrics_listener(app: web.Application):
+            runner = await start_metrics_server(FLASK_HOST, metrics_port)
+            yield
+            await runner.cleanup()
+
+        app.cleanup_ctx.append(metrics_listener)
+    try:
+        web.run_app(
+            app,
+            access_log=None,
+            keepalive_timeout=INGEST_KEEPALIVE_TIMEOUT,
+            print=None,
+            **address,
+        )
+    finally:
+        stop_writer()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    run_standalone()
@@ -0,0 +1 @@
+"""Synthetic data generator and benchmarks for the db and report code (python -m benchmarks)"""
@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, List
+
+# The bot module needs a syntactically valid token and Telegram limits don't apply to the mocked bot
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "1000000")
+os.environ.setdefault("TELEGRAM_PER_CHAT_RATE", "1000000")
+
+import db  # noqa: E402
+from benchmarks.generate import generate  # noqa: E402
+
+PERIODS = ["hour", "day", "week", "last_week", "month", "all"]
+
+
+def _percentile(samples: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of sorted samples"""
+    return samples[max(0, math.ceil(fraction * len(samples)) - 1)]
+
+
+def _timings(samples: List[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": _percentile(samples, 0.5) * 1000,
+        "p95_ms": _percentile(samples, 0.95) * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+def _measure(func: Callable[[], object], repeat: int) -> List[float]:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def bench_inserts(count: int) -> Dict[str, float]:
+    user_id = 1
+    # Player ids unique to this run: ids of an earlier run on the same database would be
+    # ignored by the unique player index and measure nothing
+    run = uuid.uuid4().hex[:12]
+    stored = 0
+    started = time.perf_counter()
+    for index in range(count):
+        stored += db.insert_event(user_id, "registration", f"bench-{run}-single-{index}", "bench", "bench")
+    single = time.perf_counter() - started
+
+    now = datetime.utcnow().replace(microsecond=0)
+    batch = [(user_id, "first_dep", f"bench-{run}-batch-{index}", "bench", "bench", now) for index in range(count)]
+    started = time.perf_counter()
+    for offset in range(0, count, 500):
+        stored += sum(db.insert_events(batch[offset:offset + 500]))
+    batched = time.perf_counter() - started
+    if stored != 2 * count:
+        raise RuntimeError(f"only {stored} of {2 * count} benchmark events were stored")
+    return {"insert_event_per_sec": count / single, "insert_events_batch500_per_sec": count / batched}
+
+
+def bench_aggregates(user_ids: List[int], repeat: int) -> Dict[str, Dict[str, float]]:
+    # The heaviest partner plus a spread over the long tail
+    sample = user_ids[:1] + user_ids[1::max(1, len(user_ids) // 20)]
+    results = {}
+    for period in PERIODS:
+        samples: List[float] = []
+        for user_id in sample:
+            samples += _measure(lambda: db.aggregate_by_campaign_and_btag(user_id, period), repeat)
+        results[period] = _timings(samples)
+    samples = []
+    for user_id in sample:
+        samples += _measure(lambda: db.aggregate_periods(user_id, ["hour", "day", "week", "last_week"]), repeat)
+    results["hourly_periods"] = _timings(samples)
+    return results
+
+
+def bench_render(user_ids: List[int], repeat: int) -> Dict[str, Dict[str, float]]:
+    import bot
+    heavy = user_ids[0]
+    return {
+        "format_report_all": _timings(_measure(lambda: bot.build_report(heavy, "all"), repeat)),
+        "format_report_week": _timings(_measure(lambda: bot.build_report(heavy, "week"), repeat)),
+        "format_hourly_report": _timings(_measure(lambda: bot.format_hourly_report(heavy), repeat)),
+    }
+
+
+def bench_hourly_pass() -> Dict[str, float]:
+    import bot
+    import db_async
+
+    sent = 0
+
+    async def send_message(chat_id: int, text: str, **kwargs):
+        nonlocal sent
+        sent += 1
+
+    bot.bot.send_message = send_message
+    started = time.perf_counter()
+    asyncio.run(bot.send_hourly_reports())
+    duration = time.perf_counter() - started
+    db_async.shutdown()
+    return {"duration_s": duration, "messages": sent}
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__)
+    parser.add_argument("--db", default="bench.sqlite3", help="scratch database (created if missing)")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--campaigns", type=int, default=10)
+    parser.add_argument("--btags", type=int, default=50)
+    parser.add_argument("--events", type=int, default=1000000)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--skew", type=float, default=1.1)
+    parser.add_argument("--inserts", type=int, default=5000, help="events for the insert throughput test")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--regenerate", action="store_true", help="drop and refill the scratch database")
+    parser.add_argument("--output", default="", help="JSON results file (default: bench-<timestamp>.json)")
+    args = parser.parse_args(argv)
+
+    db.DB_PATH = args.db
+    if args.regenerate:
+        for path in db.shard_paths():
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+    fresh = not all(os.path.exists(path) for path in db.shard_paths())
+    db.init_db()
+
+    results: Dict[str, object] = {}
+    started = time.perf_counter()
+    if fresh:
+        generate(args.users, args.campaigns, args.btags, args.events, args.days, args.skew)
+        results["generate_s"] = time.perf_counter() - started
+    user_ids = [100000 + index for index in range(args.users)]
+
+    results["aggregates"] = bench_aggregates(user_ids, args.repeat)
+    results["render"] = bench_render(user_ids, args.repeat)
+    results["send_hourly_reports"] = bench_hourly_pass()
+    # Last, so the inserted rows don't change what the read benchmarks see on reruns
+    results["inserts"] = bench_inserts(args.inserts)
+
+    report = {
+        "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "results": results,
+    }
+    output = args.output or f"bench-{datetime.utcnow():%Y%m%d-%H%M%S}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["results"], indent=2))
+    print(f"Результаты записаны в {output}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
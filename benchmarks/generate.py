@@ -0,0 +1,60 @@
+import random
+from datetime import datetime, timedelta
+from typing import List
+
+from db import insert_events, set_campaign_reward, set_reward
+
+INSERT_CHUNK = 10000
+
+
+def _zipf_weights(count: int, skew: float) -> List[float]:
+    return [1.0 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+def generate(
+    users: int,
+    campaigns: int,
+    btags: int,
+    events: int,
+    days: int = 60,
+    skew: float = 1.1,
+    dep_ratio: float = 0.3,
+    seed: int = 1,
+) -> List[int]:
+    """
+    Fills the current database (db.DB_PATH) with synthetic partners and postbacks.
+    Partners, campaigns and btags are Zipf-skewed, so a few partners own most events;
+    timestamps are spread uniformly over the last `days` days. Returns the user ids by weight.
+    """
+    rng = random.Random(seed)
+    user_ids = [100000 + index for index in range(users)]
+    campaign_ids = [f"camp{index}" for index in range(campaigns)]
+    btag_names = [f"btag{index}" for index in range(btags)]
+    user_weights = _zipf_weights(users, skew)
+    campaign_weights = _zipf_weights(campaigns, skew)
+    btag_weights = _zipf_weights(btags, skew)
+
+    for user_id in user_ids:
+        set_reward(user_id, rng.choice([5, 10, 20]))
+        for campaign_id in rng.sample(campaign_ids, k=min(2, campaigns)):
+            set_campaign_reward(user_id, campaign_id, rng.choice([15, 25, 40]))
+
+    now = datetime.utcnow().replace(microsecond=0)
+    span = days * 86400
+    written = 0
+    while written < events:
+        size = min(INSERT_CHUNK, events - written)
+        batch_users = rng.choices(user_ids, weights=user_weights, k=size)
+        batch_campaigns = rng.choices(campaign_ids, weights=campaign_weights, k=size)
+        batch_btags = rng.choices(btag_names, weights=btag_weights, k=size)
+        batch = []
+        for index in range(size):
+            event_type = "first_dep" if rng.random() < dep_ratio else "registration"
+            created_at = now - timedelta(seconds=rng.randrange(span))
+            batch.append((
+                batch_users[index], event_type, f"gen{written + index}",
+                batch_btags[index], batch_campaigns[index], created_at,
+            ))
+        insert_events(batch)
+        written += size
+    return user_ids
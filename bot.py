@@ -1,20 +1,36 @@
 import asyncio
+import html
 import logging
+import os
+import signal
 import traceback
-from datetime import datetime, timedelta
-from typing import Dict, Tuple
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
 
-from aiogram import Bot, Dispatcher
+from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
-from aiogram.filters import Command
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, Message
+from aiogram.filters import Command, CommandObject
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import (
+    CallbackQuery, FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, Message,
+)
 from aiogram.enums import ParseMode
+from aiogram.methods import GetUpdates
 
-from config import BOT_TOKEN, PREFIX, ALLOWED_USER_IDS, CAMPAIGN_NAMES
-from db import (
-    init_db, get_reward, set_reward, aggregate_by_btag, aggregate_by_campaign_and_btag, 
-    get_all_user_ids, get_campaign_reward, set_campaign_reward, get_all_campaign_rewards
+from config import (
+    BOT_TOKEN, PREFIX, ALLOWED_USER_IDS, CAMPAIGN_NAMES, REPORT_CONCURRENCY, REPORT_SEND_RETRIES, EXPORT_CONCURRENCY,
+    RETENTION_DAYS, ADMIN_USER_IDS, DB_PROFILE, REPORT_PAGE_SIZE, REPORT_SPREAD_SECONDS, REPORT_SLICE_SECONDS,
 )
+import db_async
+from db import PeriodStats, ReportPage, aggregate_page, aggregate_periods, iter_periods_for_all_users
+from export import MAX_DOCUMENT_BYTES, export_events_csv
+from fanout import MAX_MESSAGE_CHARS, fan_out, split_message
+from metrics import QUEUE_DEPTH, REPORT_LAG_SECONDS, REPORT_RENDER_SECONDS, SCHEDULER_LAG_SECONDS, timed
+from query_profile import format_top
+from report_cache import report_cache
+from retention import retention_scheduler
+import startup
 
 # Настройка логирования
 logging.basicConfig(
@@ -62,44 +78,45 @@ def main_menu_keyboard() -> ReplyKeyboardMarkup:
 def make_links_text(user_id: int) -> str:
     return (
         "Ссылка для регистрации:\n"
-        f"<code>{PREFIX}/{user_id}/registration?btag=${{btag}}&campaign_id=${{campaign_id}}</code>\n\n"
+        f"<code>{PREFIX}/{user_id}/registration?btag=${{btag}}&campaign_id=${{campaign_id}}&player_id=${{player_id}}</code>\n\n"
         "Ссылка для первого депозита:\n"
-        f"<code>{PREFIX}/{user_id}/firstdep?btag=${{btag}}&campaign_id=${{campaign_id}}</code>"
+        f"<code>{PREFIX}/{user_id}/firstdep?btag=${{btag}}&campaign_id=${{campaign_id}}&player_id=${{player_id}}</code>"
     )
 
 
-def format_report(user_id: int, period: str) -> str:
-    mapping = {"all": "Все время", "hour": "Час", "day": "День", "week": "Неделя", "last_week": "Прошлая неделя",
-               "month": "Месяц"}
-    title = mapping.get(period, "Все время")
-    stats = aggregate_by_campaign_and_btag(user_id, period)
-    if not stats:
+REPORT_TITLES = {"all": "Все время", "hour": "Час", "day": "День", "week": "Неделя", "last_week": "Прошлая неделя",
+                 "month": "Месяц"}
+
+
+def _page_count(report_page: ReportPage) -> int:
+    return max(1, -(-report_page.row_count // report_page.limit))
+
+
+def render_report(period: str, report_page: ReportPage) -> str:
+    title = REPORT_TITLES.get(period, "Все время")
+    total_regs, total_deps, total_reward = report_page.totals
+    if not report_page.rows:
         return f"📊 Отчет ({title})\n\nНет данных."
     
     lines = [f"📊 Отчет ({title})", ""]
-    total_regs = total_deps = 0
-    total_reward = 0.0
     
-    # Sort campaigns by name (from config) or by campaign_id
     def get_campaign_name(campaign_id: str) -> str:
         if campaign_id in CAMPAIGN_NAMES:
             return CAMPAIGN_NAMES[campaign_id]
         return campaign_id or "Без компании"
     
-    sorted_campaigns = sorted(stats.keys(), key=lambda x: get_campaign_name(x))
+    # Rows come with the most deposits first; campaigns are listed in the order of their best btag
+    campaigns: Dict[str, List[Tuple[str, int, int, float]]] = {}
+    for campaign_id, btag, regs, deps, reward_sum in report_page.rows:
+        campaigns.setdefault(campaign_id, []).append((btag, regs, deps, reward_sum))
     
-    for campaign_id in sorted_campaigns:
-        campaign_name = get_campaign_name(campaign_id)
-        campaign_stats = stats[campaign_id]
-        if not campaign_stats:
-            continue
-        
+    for campaign_id, campaign_rows in campaigns.items():
         # Add company header
-        lines.append(f"<b>🏢 {campaign_name}</b>")
+        lines.append(f"<b>🏢 {get_campaign_name(campaign_id)}</b>")
         lines.append("")
         
         # Add btag stats within company
-        for btag, (regs, deps, reward_sum) in sorted(campaign_stats.items()):
+        for btag, regs, deps, reward_sum in campaign_rows:
             lines.append(
                 "\n".join([
                     f"<blockquote>BTag: {btag or '-'}",
@@ -109,13 +126,18 @@ def format_report(user_id: int, period: str) -> str:
                 ])
             )
             lines.append("")  # пустая строка между блоками
-            total_regs += regs
-            total_deps += deps
-            total_reward += reward_sum
         
         lines.append("")  # пустая строка между компаниями
     
     lines += ["", f"Итого: регистрации {total_regs}, депозиты {total_deps}, сумма: {round(total_reward, 2)}"]
+    pages = _page_count(report_page)
+    if pages > 1:
+        first = report_page.offset + 1
+        last = report_page.offset + len(report_page.rows)
+        lines.append(
+            f"Страница {report_page.offset // report_page.limit + 1} из {pages} "
+            f"(BTag {first}–{last} из {report_page.row_count}, по убыванию депозитов)"
+        )
 
     return "\n".join([
         f"📊 Отчет ({title})",
@@ -126,6 +148,50 @@ def format_report(user_id: int, period: str) -> str:
     ])
 
 
+@timed(REPORT_RENDER_SECONDS, "report")
+def build_report(
+    user_id: int, period: str, page: int = 0, page_size: int = REPORT_PAGE_SIZE,
+) -> Tuple[ReportPage, str]:
+    """
+    Fetches and renders one page of the report; a page past the end (data changed) shows the last one.
+    A page whose text doesn't fit in one message is fetched again with half as many rows, from the
+    same first row, so long btags or campaign names never cut a page short.
+    """
+    offset = page * page_size
+    while True:
+        report_page = aggregate_page(user_id, period, page_size, offset // page_size * page_size)
+        if not report_page.rows and offset > 0:
+            last_page = _page_count(aggregate_page(user_id, period, page_size, 0)) - 1
+            report_page = aggregate_page(user_id, period, page_size, last_page * page_size)
+        text = render_report(period, report_page)
+        if len(text) <= MAX_MESSAGE_CHARS or page_size == 1:
+            return report_page, text
+        page_size = max(1, page_size // 2)
+
+
+def report_keyboard(period: str, report_page: ReportPage) -> Optional[InlineKeyboardMarkup]:
+    pages = _page_count(report_page)
+    if pages <= 1:
+        return None
+    page_size = report_page.limit
+    page = report_page.offset // page_size
+    buttons = []
+    # The page size travels with the buttons, as a page too long for a message is fetched with fewer rows
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="◀️", callback_data=f"report:{period}:{page - 1}:{page_size}"))
+    buttons.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="report:noop"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton(text="▶️", callback_data=f"report:{period}:{page + 1}:{page_size}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+
+def format_report(
+    user_id: int, period: str, page: int = 0, page_size: int = REPORT_PAGE_SIZE,
+) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    report_page, text = report_cache.get_or_build(user_id, period, page, page_size, build_report)
+    return text, report_keyboard(period, report_page)
+
+
 def _summarize(stats: Dict[str, Tuple[int, int, float]]) -> Tuple[int, int, float]:
     total_regs = sum(item[0] for item in stats.values())
     total_deps = sum(item[1] for item in stats.values())
@@ -146,30 +212,26 @@ def _format_summary_line(label: str, summary: Tuple[int, int, float]) -> str:
     return f"{(label + ':').ljust(11)}{regs} рег | 💰{deps}fd | {_format_reward(reward)}"
 
 
-def _summarize_campaign_stats(stats: Dict[str, Dict[str, Tuple[int, int, float]]]) -> Tuple[int, int, float]:
-    total_regs = 0
-    total_deps = 0
-    total_reward = 0.0
-    for campaign_stats in stats.values():
-        for regs, deps, reward in campaign_stats.values():
-            total_regs += regs
-            total_deps += deps
-            total_reward += reward
-    return total_regs, total_deps, total_reward
+HOURLY_REPORT_PERIODS = ["hour", "day", "week", "last_week"]
 
 
-def format_hourly_report(user_id: int) -> str:
+def _stats_user_id(user_id: int) -> int:
+    """Whose statistics the user sees"""
     if user_id == 1854386613:
-        user_id = 1051111502
-    hour_stats = aggregate_by_campaign_and_btag(user_id, "hour")
-    day_stats = aggregate_by_campaign_and_btag(user_id, "day")
-    week_stats = aggregate_by_campaign_and_btag(user_id, "week")
-    last_week_stats = aggregate_by_campaign_and_btag(user_id, "last_week")
+        return 1051111502
+    return user_id
+
+
+@timed(REPORT_RENDER_SECONDS, "hourly")
+def format_hourly_report(user_id: int, periods: Optional[Dict[str, PeriodStats]] = None) -> str:
+    if periods is None:
+        periods = aggregate_periods(_stats_user_id(user_id), HOURLY_REPORT_PERIODS)
+    day_stats = periods["day"].stats
 
-    hour_summary = _summarize_campaign_stats(hour_stats)
-    day_summary = _summarize_campaign_stats(day_stats)
-    week_summary = _summarize_campaign_stats(week_stats)
-    last_week_summary = _summarize_campaign_stats(last_week_stats)
+    hour_summary = periods["hour"].totals
+    day_summary = periods["day"].totals
+    week_summary = periods["week"].totals
+    last_week_summary = periods["last_week"].totals
 
     summary_lines = [
         _format_summary_line("Час", hour_summary),
@@ -218,6 +280,23 @@ def format_hourly_report(user_id: int) -> str:
     return "\n".join(lines)
 
 
+@timed(REPORT_RENDER_SECONDS, "hourly_all")
+def build_hourly_reports(user_ids: List[int]) -> Dict[int, str]:
+    """Renders hourly reports for the users from one bulk aggregation instead of queries per user"""
+    recipients: Dict[int, List[int]] = {}
+    for user_id in user_ids:
+        recipients.setdefault(_stats_user_id(user_id), []).append(user_id)
+    reports: Dict[int, str] = {}
+    for stats_user_id, periods in iter_periods_for_all_users(HOURLY_REPORT_PERIODS, sorted(recipients)):
+        for user_id in recipients.get(stats_user_id, []):
+            reports[user_id] = format_hourly_report(user_id, periods)
+    empty = {period: PeriodStats({}, (0, 0, 0.0)) for period in HOURLY_REPORT_PERIODS}
+    for user_id in user_ids:
+        if user_id not in reports:
+            reports[user_id] = format_hourly_report(user_id, empty)
+    return reports
+
+
 def check_access(user_id: int) -> bool:
     return True
     """Проверяет, есть ли у пользователя доступ к боту"""
@@ -226,6 +305,28 @@ def check_access(user_id: int) -> bool:
     return user_id in ALLOWED_USER_IDS
 
 
+def is_admin(user_id: int) -> bool:
+    return user_id in ADMIN_USER_IDS
+
+
+@dp.message(Command("slowqueries"))
+async def cmd_slow_queries(message: Message):
+    logger.info(f"Получена команда /slowqueries от пользователя {message.from_user.id}")
+    if not is_admin(message.from_user.id):
+        logger.warning(f"Попытка доступа к команде администратора от пользователя {message.from_user.id}")
+        await message.answer("❌ Команда доступна только администраторам.")
+        return
+    if not DB_PROFILE:
+        await message.answer("Профилирование запросов выключено (DB_PROFILE=1).")
+        return
+    entries = [f"<pre>{html.escape(entry)}</pre>" for entry in format_top()]
+    if not entries:
+        await message.answer("Нет данных о запросах.")
+        return
+    for part in split_message("\n\n".join(["🐢 Самые дорогие запросы:", *entries])):
+        await message.answer(part)
+
+
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
     logger.info(f"Получена команда /start от пользователя {message.from_user.id} (@{message.from_user.username})")
@@ -234,9 +335,8 @@ async def cmd_start(message: Message):
         await message.answer("❌ У вас нет доступа к этому боту.")
         return
     try:
-        init_db()
-        current = get_reward(message.from_user.id)
-        campaign_rewards = get_all_campaign_rewards(message.from_user.id)
+        current = await db_async.get_reward(message.from_user.id)
+        campaign_rewards = await db_async.get_all_campaign_rewards(message.from_user.id)
         
         text_lines = [
             "👋 Добро пожаловать! Это партнерский бот.\n",
@@ -273,8 +373,78 @@ async def cmd_generate(message: Message):
         await message.answer("❌ Произошла ошибка при генерации ссылок.")
 
 
+EXPORT_PERIODS = ["all", "hour", "day", "week", "last_week", "month"]
+export_semaphore = asyncio.Semaphore(EXPORT_CONCURRENCY)
 
 
+@dp.message(Command("export"))
+async def cmd_export(message: Message, command: CommandObject):
+    logger.info(f"Получена команда /export от пользователя {message.from_user.id}: {command.args}")
+    if not check_access(message.from_user.id):
+        logger.warning(f"Попытка доступа от неразрешенного пользователя {message.from_user.id}")
+        await message.answer("❌ У вас нет доступа к этому боту.")
+        return
+    args = (command.args or "").split()
+    compress = "gz" in args
+    periods = [arg for arg in args if arg != "gz"]
+    period = periods[0] if periods else "all"
+    if period not in EXPORT_PERIODS or len(periods) > 1:
+        await message.answer(
+            f"Использование: /export [{'|'.join(EXPORT_PERIODS)}] [gz]",
+            reply_markup=main_menu_keyboard(),
+        )
+        return
+    path = None
+    try:
+        await message.answer("⏳ Готовлю выгрузку...")
+        async with export_semaphore:
+            path = await db_async.run(export_events_csv, _stats_user_id(message.from_user.id), period, compress)
+        if os.path.getsize(path) > MAX_DOCUMENT_BYTES:
+            await message.answer("❌ Файл слишком большой для Telegram. Выберите период короче или добавьте gz.")
+            return
+        filename = f"events_{period}.csv" + (".gz" if compress else "")
+        await message.answer_document(FSInputFile(path, filename=filename), reply_markup=main_menu_keyboard())
+        logger.info(f"Выгрузка '{period}' отправлена пользователю {message.from_user.id}")
+    except Exception as e:
+        logger.error(f"Ошибка при обработке /export: {e}", exc_info=True)
+        await message.answer("❌ Произошла ошибка при выгрузке.")
+    finally:
+        if path is not None:
+            os.remove(path)
+
+
+
+
+
+
+@dp.callback_query(F.data.startswith("report:"))
+async def on_report_page(callback: CallbackQuery):
+    """Inline keyboard paging: replaces the report message with the requested page"""
+    parts = callback.data.split(":")
+    # Buttons of messages sent before the page size was added have no fourth part
+    if len(parts) == 3:
+        parts.append(str(REPORT_PAGE_SIZE))
+    if len(parts) != 4 or parts[1] not in REPORT_TITLES or not parts[2].isdigit() or not parts[3].isdigit():
+        await callback.answer()
+        return
+    period, page, page_size = parts[1], int(parts[2]), min(max(int(parts[3]), 1), REPORT_PAGE_SIZE)
+    logger.info(f"Запрос страницы {page + 1} отчета '{period}' от пользователя {callback.from_user.id}")
+    if not check_access(callback.from_user.id):
+        await callback.answer("❌ У вас нет доступа к этому боту.", show_alert=True)
+        return
+    try:
+        uid = _stats_user_id(int(callback.from_user.id))
+        report_text, pages_keyboard = await db_async.run(format_report, uid, period, page, page_size)
+        await callback.message.edit_text(report_text, reply_markup=pages_keyboard)
+        await callback.answer()
+    except TelegramBadRequest as e:
+        # The same page was requested again
+        if "message is not modified" not in str(e):
+            logger.error(f"Ошибка при переключении страницы отчета: {e}", exc_info=True)
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка при переключении страницы отчета: {e}", exc_info=True)
+        await callback.answer("❌ Произошла ошибка.", show_alert=True)
 
 
 @dp.message()
@@ -297,7 +467,7 @@ async def on_any_message(message: Message):
             try:
                 value = float(text)
                 logger.info(f"Установка вознаграждения для компании {campaign_id} пользователя {message.from_user.id}: {value}")
-                set_campaign_reward(message.from_user.id, campaign_id, value)
+                await db_async.set_campaign_reward(message.from_user.id, campaign_id, value)
                 awaiting_campaign_reward_input.pop(message.from_user.id, None)
                 campaign_name = CAMPAIGN_NAMES.get(campaign_id, campaign_id or "Без компании")
                 await message.reply(
@@ -319,7 +489,7 @@ async def on_any_message(message: Message):
             try:
                 value = float(text)
                 logger.info(f"Установка вознаграждения для пользователя {message.from_user.id}: {value}")
-                set_reward(message.from_user.id, value)
+                await db_async.set_reward(message.from_user.id, value)
                 awaiting_reward_input.pop(message.from_user.id, None)
                 await message.reply(f"Готово. Новое вознаграждение: {value:.2f}", reply_markup=main_menu_keyboard())
                 return
@@ -364,8 +534,8 @@ async def on_any_message(message: Message):
                 return
             
             # Показываем список компаний с текущими ставками
-            campaign_rewards = get_all_campaign_rewards(message.from_user.id)
-            default_reward = get_reward(message.from_user.id)
+            campaign_rewards = await db_async.get_all_campaign_rewards(message.from_user.id)
+            default_reward = await db_async.get_reward(message.from_user.id)
             
             lines = ["Выберите компанию для установки ставки:\n"]
             for campaign_id, company_name in sorted(CAMPAIGN_NAMES.items()):
@@ -384,8 +554,8 @@ async def on_any_message(message: Message):
         if text in CAMPAIGN_NAMES:
             campaign_id = text
             campaign_name = CAMPAIGN_NAMES[campaign_id]
-            current_reward = get_campaign_reward(message.from_user.id, campaign_id)
-            default_reward = get_reward(message.from_user.id)
+            current_reward = await db_async.get_campaign_reward(message.from_user.id, campaign_id)
+            default_reward = await db_async.get_reward(message.from_user.id)
             
             if current_reward is not None:
                 reward_text = f"Текущая ставка: {current_reward:.2f}"
@@ -414,11 +584,12 @@ async def on_any_message(message: Message):
         if text in period_map:
             period = period_map[text]
             logger.info(f"Запрос отчета '{period}' от пользователя {message.from_user.id}")
-            uid = int(message.from_user.id)
-            if uid == 1854386613:
-                uid = 1051111502
-            report_text = format_report(uid, period)
-            await message.answer(report_text, reply_markup=main_menu_keyboard())
+            uid = _stats_user_id(int(message.from_user.id))
+            report_text, pages_keyboard = await db_async.run(format_report, uid, period)
+            parts = split_message(report_text)
+            for part in parts[:-1]:
+                await message.answer(part)
+            await message.answer(parts[-1], reply_markup=pages_keyboard or main_menu_keyboard())
             return
         
         # Если текст не распознан, просто логируем
@@ -431,38 +602,143 @@ async def on_any_message(message: Message):
 
 
 
-async def send_hourly_reports():
-    logger.info("Отправка часовых отчетов")
-    user_ids = get_all_user_ids()
+async def send_hourly_reports(
+    user_ids: Optional[List[int]] = None,
+    on_delivered: Optional[Callable[[int], None]] = None,
+) -> None:
+    """Builds and sends hourly reports to user_ids (all users by default) right away"""
+    if user_ids is None:
+        user_ids = await db_async.get_all_user_ids()
     if not user_ids:
         logger.info("Нет пользователей для отправки отчетов")
         return
-    logger.info(f"Отправка отчетов {len(user_ids)} пользователям")
+    logger.info(f"Отправка часовых отчетов {len(user_ids)} пользователям")
+    reports = await db_async.run(build_hourly_reports, user_ids)
+
+    async def build(user_id: int) -> str:
+        return reports[user_id]
+
+    await fan_out(
+        user_ids,
+        build=build,
+        send=lambda user_id, text: bot.send_message(user_id, text),
+        concurrency=REPORT_CONCURRENCY,
+        retries=REPORT_SEND_RETRIES,
+        name="часовые отчеты",
+        on_delivered=on_delivered,
+    )
+    logger.info(f"Кэш отчетов: {report_cache.stats()}")
+
+
+def report_offset(user_id: int) -> int:
+    """Seconds after the top of the hour at which the user's report is due; the same in every process and run"""
+    if REPORT_SPREAD_SECONDS <= 0:
+        return 0
+    return zlib.crc32(str(user_id).encode()) % REPORT_SPREAD_SECONDS
+
+
+def _report_slot(hour_start: datetime, user_id: int) -> datetime:
+    """Start of the slice the user's report belongs to"""
+    slice_seconds = max(1, REPORT_SLICE_SECONDS)
+    return hour_start + timedelta(seconds=report_offset(user_id) // slice_seconds * slice_seconds)
+
+
+async def _send_report_slice(user_ids: List[int], hour_start: datetime, hour_ts: int, kind: str) -> None:
+    """Sends reports to a group of users and records the ones they reached"""
+    delivered: List[int] = []
+
+    def on_delivered(user_id: int) -> None:
+        delivered.append(user_id)
+        REPORT_LAG_SECONDS.observe((datetime.utcnow() - _report_slot(hour_start, user_id)).total_seconds(), kind)
+
+    try:
+        await send_hourly_reports(user_ids, on_delivered)
+    finally:
+        # Also after an error, so users already reached don't get the report again after a restart
+        if delivered:
+            await db_async.set_report_runs(delivered, hour_ts)
+
+
+async def send_reports_for_hour(hour_start: datetime, catch_up: bool = False) -> None:
+    """
+    Sends the reports of the hour starting at hour_start (UTC) to users that haven't received it:
+    users are split into slices by report_offset() and each slice is aggregated and sent at its
+    time, so the load is spread over REPORT_SPREAD_SECONDS instead of peaking at the top of the hour.
+    Users whose slot has already passed (e.g. missed while the process was down) get theirs at once;
+    a user who missed several hours gets one report with the current statistics.
+    """
+    hour_ts = int(hour_start.replace(tzinfo=timezone.utc).timestamp())
+    user_ids = await db_async.get_all_user_ids()
+    runs = await db_async.get_report_runs()
+    now = datetime.utcnow()
+    overdue: List[int] = []
+    slices: Dict[datetime, List[int]] = {}
     for user_id in user_ids:
-        try:
-            report_text = format_hourly_report(user_id)
-            await bot.send_message(user_id, report_text)
-            logger.info(f"Отчет отправлен пользователю {user_id}")
-        except Exception as e:
-            logger.error(f"Ошибка при отправке отчета пользователю {user_id}: {e}", exc_info=True)
+        if runs.get(user_id, -1) >= hour_ts:
+            continue
+        slot = _report_slot(hour_start, user_id)
+        if slot <= now:
+            overdue.append(user_id)
+        else:
+            slices.setdefault(slot, []).append(user_id)
+    pending = len(overdue) + sum(len(slice_users) for slice_users in slices.values())
+    QUEUE_DEPTH.set(pending, "hourly_reports")
+    if not pending:
+        return
+    logger.info(
+        f"Часовые отчеты за {hour_start:%Y-%m-%d %H}:00: {pending} пользователей, "
+        f"сразу {len(overdue)}, остальные в {len(slices)} частях за {REPORT_SPREAD_SECONDS} с"
+    )
+
+    if overdue:
+        # At the top of the hour these are just the users with offset 0
+        await _send_report_slice(overdue, hour_start, hour_ts, "catch_up" if catch_up else "slot")
+        pending -= len(overdue)
+        QUEUE_DEPTH.set(pending, "hourly_reports")
+    for slot in sorted(slices):
+        delay = (slot - datetime.utcnow()).total_seconds()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        SCHEDULER_LAG_SECONDS.set(max(0.0, -delay), "start")
+        await _send_report_slice(slices[slot], hour_start, hour_ts, "slot")
+        pending -= len(slices[slot])
+        QUEUE_DEPTH.set(pending, "hourly_reports")
+    finish_due = hour_start + timedelta(seconds=REPORT_SPREAD_SECONDS)
+    SCHEDULER_LAG_SECONDS.set((datetime.utcnow() - finish_due).total_seconds(), "finish")
 
 
 async def hourly_report_scheduler():
-    logger.info("Запущен планировщик часовых отчетов")
+    logger.info(
+        f"Запущен планировщик часовых отчетов (рассылка в течение {REPORT_SPREAD_SECONDS} с после начала часа)"
+    )
+    # The first pass catches up on the current hour: reports due while the process was down
+    catch_up = True
     while True:
         try:
+            hour_start = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+            await send_reports_for_hour(hour_start, catch_up)
+            catch_up = False
             now = datetime.utcnow()
-            next_hour = (now + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
-            sleep_seconds = (next_hour - now).total_seconds()
-            logger.info(f"Ожидание до следующего часа: {sleep_seconds} секунд")
+            next_hour = hour_start + timedelta(hours=1)
+            sleep_seconds = max(0.0, (next_hour - now).total_seconds())
+            logger.info(f"Ожидание до следующего часа: {sleep_seconds:.0f} секунд")
             await asyncio.sleep(sleep_seconds)
-            await send_hourly_reports()
         except Exception as e:
             logger.error(f"Ошибка в планировщике отчетов: {e}", exc_info=True)
             await asyncio.sleep(60)  # Ждем минуту перед повтором
 
 
-async def run_bot():
+async def _report_first_poll(make_request, bot: Bot, method):
+    # Request middleware: the first getUpdates means the bot is ready for updates
+    if isinstance(method, GetUpdates):
+        bot.session.middleware.unregister(_report_first_poll)
+        startup.mark("first_poll")
+        startup.report()
+    return await make_request(bot, method)
+
+
+async def run_bot(polling: bool = True, scheduler: bool = True):
+    """Runs the bot's update polling and/or the report schedulers until stopped"""
     logger.info("=" * 50)
     logger.info("Запуск бота...")
     logger.info("=" * 50)
@@ -475,18 +751,33 @@ async def run_bot():
     
     try:
         logger.info("Инициализация базы данных...")
-        init_db()
+        await db_async.init_db()
         logger.info("✓ База данных инициализирована")
         
-        # Запускаем планировщик отчетов в фоне
-        logger.info("Запуск планировщика часовых отчетов в фоновом режиме...")
-        asyncio.create_task(hourly_report_scheduler())
-        logger.info("✓ Планировщик запущен")
-        
-        logger.info("Начало polling бота...")
-        logger.info("Бот готов к работе. Ожидание сообщений...")
-        logger.info("=" * 50)
-        await dp.start_polling(bot, allowed_updates=["message"])
+        if scheduler:
+            # Запускаем планировщик отчетов в фоне
+            logger.info("Запуск планировщика часовых отчетов в фоновом режиме...")
+            asyncio.create_task(hourly_report_scheduler())
+            logger.info("✓ Планировщик запущен")
+
+            if RETENTION_DAYS > 0:
+                asyncio.create_task(retention_scheduler())
+
+        if polling:
+            logger.info("Начало polling бота...")
+            logger.info("Бот готов к работе. Ожидание сообщений...")
+            logger.info("=" * 50)
+            bot.session.middleware(_report_first_poll)
+            await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
+        else:
+            startup.report()
+            # Only the schedulers: nothing to poll, run until SIGTERM/SIGINT
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(signum, stop.set)
+            logger.info("Планировщик работает без polling бота")
+            await stop.wait()
     except KeyboardInterrupt:
         logger.info("Получен сигнал остановки (KeyboardInterrupt)")
     except Exception as e:
@@ -0,0 +1,121 @@
+import csv
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Union
+
+from config import BULK_CHUNK_SIZE, BULK_MAX_CLOCK_SKEW
+from db import insert_events
+from ingest import Event
+from report_cache import report_cache
+
+EVENT_TYPES = {"registration": "registration", "firstdep": "first_dep", "first_dep": "first_dep"}
+CSV_FIELDS = ["user", "type", "btag", "campaign_id", "player_id", "timestamp"]
+MAX_REPORTED_ERRORS = 20
+
+
+def _parse_timestamp(value: Union[str, int, float, None]) -> datetime:
+    """
+    UTC epoch seconds or ISO 8601 (naive means UTC); missing means now. Moments more than
+    BULK_MAX_CLOCK_SKEW seconds in the future are rejected: they would show up in reports early.
+    """
+    now = datetime.utcnow()
+    if value is None or value == "":
+        return now.replace(microsecond=0)
+    # JSON true/false are ints to Python, and lists/objects have no timestamp reading
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError(f"timestamp {value!r} is not a number or a string")
+    if isinstance(value, (int, float)) or value.replace(".", "", 1).isdigit():
+        moment = datetime.utcfromtimestamp(float(value))
+    else:
+        moment = datetime.fromisoformat(value)
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    if moment > now + timedelta(seconds=BULK_MAX_CLOCK_SKEW):
+        raise ValueError(f"timestamp {value!r} is in the future")
+    return moment.replace(microsecond=0)
+
+
+def _parse_record(record: Dict[str, object]) -> Event:
+    event_type = EVENT_TYPES.get(str(record.get("type") or ""))
+    if event_type is None:
+        raise ValueError(f"unknown type {record.get('type')!r}")
+    user = int(str(record.get("user")))
+
+    def text(key: str) -> Optional[str]:
+        value = record.get(key)
+        return None if value is None or value == "" else str(value)
+
+    return (user, event_type, text("player_id"), text("btag"), text("campaign_id"), _parse_timestamp(record.get("timestamp")))
+
+
+class BulkImport:
+    """
+    Incremental import of an NDJSON or CSV postback batch.
+    Lines are fed one at a time and parsed events are written every BULK_CHUNK_SIZE
+    rows in one transaction, so the body never has to be held in memory.
+    CSV input has one record per line; a header row with CSV_FIELDS names is optional.
+    """
+
+    def __init__(self, fmt: str):
+        self.fmt = fmt
+        self.accepted = 0
+        self.duplicate = 0
+        self.rejected = 0
+        self.errors: List[Dict[str, object]] = []
+        self._line = 0
+        self._csv_fields = CSV_FIELDS
+        self._pending: List[Event] = []
+
+    def feed(self, line: Union[str, bytes]) -> None:
+        self._line += 1
+        if isinstance(line, bytes):
+            line = line.decode("utf-8-sig" if self._line == 1 else "utf-8", errors="replace")
+        line = line.strip()
+        if not line:
+            return
+        try:
+            if self.fmt == "csv":
+                values = next(csv.reader([line]))
+                if self._line == 1 and "type" in values and "user" in values:
+                    self._csv_fields = values
+                    return
+                record = dict(zip(self._csv_fields, values))
+            else:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("record is not an object")
+            self._pending.append(_parse_record(record))
+        except (ValueError, TypeError, OverflowError) as e:
+            self.rejected += 1
+            if len(self.errors) < MAX_REPORTED_ERRORS:
+                self.errors.append({"line": self._line, "error": str(e)})
+
+    def ready(self) -> bool:
+        return len(self._pending) >= BULK_CHUNK_SIZE
+
+    def flush(self) -> None:
+        """Writes pending events in one transaction; reward snapshots are resolved once per user"""
+        if not self._pending:
+            return
+        inserted = insert_events(self._pending)
+        stored = sum(inserted)
+        self.accepted += stored
+        self.duplicate += len(inserted) - stored
+        for telegram_user_id in {event[0] for event, ok in zip(self._pending, inserted) if ok}:
+            report_cache.invalidate_user(telegram_user_id)
+        self._pending = []
+
+    def summary(self) -> Dict[str, object]:
+        return {
+            "status": "ok",
+            "accepted": self.accepted,
+            "duplicate": self.duplicate,
+            "rejected": self.rejected,
+            "errors": self.errors,
+        }
+
+
+def detect_format(content_type: Optional[str], fmt: Optional[str]) -> str:
+    if fmt in ("csv", "ndjson"):
+        return fmt
+    return "csv" if content_type and "csv" in content_type else "ndjson"
@@ -11,12 +11,98 @@ PREFIX = os.getenv("PREFIX", "http://localhost:5000")
 FLASK_HOST = os.getenv("FLASK_HOST", "0.0.0.0")
 FLASK_PORT = int(os.getenv("FLASK_PORT", "8000"))
 
+# Postback HTTP server: "flask" (threaded, in a separate thread) or "aiohttp" (in the bot's event loop)
+INGEST_SERVER = os.getenv("INGEST_SERVER", "flask")
+# Seconds an idle keep-alive connection of the aiohttp server is kept open
+INGEST_KEEPALIVE_TIMEOUT = float(os.getenv("INGEST_KEEPALIVE_TIMEOUT", "75"))
+
+# Process roles started by run.py when no role is given on the command line: "all" (postbacks,
+# bot and scheduler in one process), a comma-separated subset of "ingest", "bot", "scheduler",
+# or "supervisor" (INGEST_WORKERS postback processes on one shared socket plus a bot/scheduler process)
+RUN_ROLE = os.getenv("RUN_ROLE", "all")
+# Postback worker processes of the supervisor; 0 means one per CPU
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "0"))
+# Seconds the supervisor waits for its processes to finish after SIGTERM before killing them
+WORKER_SHUTDOWN_TIMEOUT = float(os.getenv("WORKER_SHUTDOWN_TIMEOUT", "15"))
+# Port of the /metrics listener of a process without the ingest role (e.g. the supervisor's
+# bot/scheduler process); postback servers serve /metrics on FLASK_PORT. 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "8001"))
+
+# Postback ingestion mode: "queue" buffers events in memory and group-commits them
+# from one writer thread per shard, "sync" writes every postback inside the request handler
+INGEST_MODE = os.getenv("INGEST_MODE", "queue")
+# Queue size of each shard's writer
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+# A batch is committed once it has INGEST_BATCH_SIZE events or INGEST_FLUSH_MS have passed
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", "50"))
+
+# Events per transaction for the bulk postback endpoint
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "2000"))
+# Imported events may be stamped at most this many seconds ahead of the server clock
+BULK_MAX_CLOCK_SKEW = int(os.getenv("BULK_MAX_CLOCK_SKEW", "300"))
+
+# Recently accepted postbacks remembered in memory to answer network retries without a write
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "200000"))
+
+# SQLite connection pool and tuning
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "30"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", str(64 * 1024)))
+# Partners are split by telegram_user_id over DB_SHARDS database files (data.0.sqlite3, ...),
+# each with its own write lock; 1 keeps the single data.sqlite3. Change it only with reshard.py
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+# Worker threads serving database calls from the bot's event loop
+DB_ASYNC_WORKERS = int(os.getenv("DB_ASYNC_WORKERS", "4"))
+# Rows per transaction for data migrations on existing databases
+MIGRATION_CHUNK_SIZE = int(os.getenv("MIGRATION_CHUNK_SIZE", "5000"))
+# Opt-in statement profiling: times every statement, logs the ones slower than DB_SLOW_QUERY_MS
+# with their query plan and keeps the DB_QUERY_TOP_N most expensive query shapes
+# over a rolling window of DB_QUERY_STATS_WINDOW seconds
+DB_PROFILE = os.getenv("DB_PROFILE", "0") == "1"
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+DB_QUERY_TOP_N = int(os.getenv("DB_QUERY_TOP_N", "15"))
+DB_QUERY_STATS_WINDOW = int(os.getenv("DB_QUERY_STATS_WINDOW", "3600"))
+
 # Default reward per first deposit if user hasn't set it yet
 DEFAULT_REWARD_PER_DEP = float(os.getenv("DEFAULT_REWARD_PER_DEP", "1"))
 
+# Telegram send limits for report fan-out: messages per second overall and per chat
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_PER_CHAT_RATE = float(os.getenv("TELEGRAM_PER_CHAT_RATE", "1"))
+# Hourly reports built/sent concurrently and send retries per report
+REPORT_CONCURRENCY = int(os.getenv("REPORT_CONCURRENCY", "16"))
+REPORT_SEND_RETRIES = int(os.getenv("REPORT_SEND_RETRIES", "3"))
+# Hourly reports are spread over the first REPORT_SPREAD_SECONDS of the hour, each user at a fixed
+# offset (0 sends all of them at the top of the hour); users whose offsets fall into the same
+# REPORT_SLICE_SECONDS are aggregated and sent together
+REPORT_SPREAD_SECONDS = int(os.getenv("REPORT_SPREAD_SECONDS", "600"))
+REPORT_SLICE_SECONDS = int(os.getenv("REPORT_SLICE_SECONDS", "30"))
+
+# Cache of rendered reports: memory cap and the time bucket that bounds staleness of rolling periods
+REPORT_CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+REPORT_CACHE_BUCKET_SECONDS = int(os.getenv("REPORT_CACHE_BUCKET_SECONDS", "60"))
+# BTags per report page; reports with more are paged with an inline keyboard
+REPORT_PAGE_SIZE = int(os.getenv("REPORT_PAGE_SIZE", "20"))
+
+# Event exports built at the same time (each holds a db worker while it runs)
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "1"))
+
+# Raw events older than RETENTION_DAYS full days are moved to ARCHIVE_DB_PATH once a day
+# (0 disables); reports keep their totals from the rollup tables
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "0"))
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", "archive.sqlite3")
+RETENTION_CHUNK_SIZE = int(os.getenv("RETENTION_CHUNK_SIZE", "2000"))
+RETENTION_PAUSE_MS = int(os.getenv("RETENTION_PAUSE_MS", "50"))
+
 # Allowed user IDs for bot access (comma-separated)
 ALLOWED_USER_IDS = [int(uid.strip()) for uid in os.getenv("ALLOWED_USER_IDS", "").split(",") if uid.strip()]
 
+# User IDs allowed to use admin commands such as /slowqueries (comma-separated)
+ADMIN_USER_IDS = [int(uid.strip()) for uid in os.getenv("ADMIN_USER_IDS", "").split(",") if uid.strip()]
+
 # Campaign ID to Company Name mapping
 # Format: "campaign_id1:Company Name 1,campaign_id2:Company Name 2"
 CAMPAIGN_NAMES = {}
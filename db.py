@@ -1,129 +1,740 @@
+import heapq
+import json
+import logging
+import math
+import os
 import sqlite3
+import threading
+import time
 from contextlib import contextmanager
-from datetime import datetime, timedelta
-from typing import Dict, Tuple, Optional, List
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterator, NamedTuple, Set, Tuple, Optional, List
 
-from config import DEFAULT_REWARD_PER_DEP
+from config import (
+    DEFAULT_REWARD_PER_DEP, DB_POOL_SIZE, DB_BUSY_TIMEOUT, DB_STATEMENT_CACHE_SIZE, DB_MMAP_SIZE, DB_CACHE_SIZE_KB,
+    MIGRATION_CHUNK_SIZE, DB_PROFILE, DB_SHARDS,
+)
+from metrics import DB_QUERY_SECONDS, timed
+from minute_window import MinuteWindow
+from query_profile import ProfiledConnection
+
+logger = logging.getLogger(__name__)
 
 
 DB_PATH = "data.sqlite3"
 
+# campaign_id -> {btag -> (registrations_count, first_deposits_count, total_reward_sum)}
+CampaignStats = Dict[str, Dict[str, Tuple[int, int, float]]]
 
-@contextmanager
-def open_db():
-    conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
+
+class PeriodStats(NamedTuple):
+    stats: CampaignStats
+    totals: Tuple[int, int, float]
+
+
+class ReportPage(NamedTuple):
+    # (campaign_id, btag, registrations_count, first_deposits_count, total_reward_sum)
+    rows: List[Tuple[str, str, int, int, float]]
+    totals: Tuple[int, int, float]
+    row_count: int
+    offset: int
+    # Rows per page the page was fetched with
+    limit: int
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Opens a new tuned connection; most code should use open_db()/open_user_db() instead"""
+    conn = sqlite3.connect(
+        path,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_STATEMENT_CACHE_SIZE,
+        check_same_thread=False,
+        factory=ProfiledConnection if DB_PROFILE else sqlite3.Connection,
+    )
     conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-        conn.commit()
-    finally:
+    # Only takes effect on a new, empty database (existing ones need a VACUUM);
+    # lets retention give freed pages back in small steps
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)}")
+    conn.execute(f"PRAGMA cache_size=-{int(DB_CACHE_SIZE_KB)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class _ConnectionPool:
+    """
+    Keeps up to `size` idle long-lived connections per database file.
+    A thread holds at most one connection at a time: nested open_db() calls reuse it,
+    and only the outermost one commits or rolls back.
+    """
+
+    def __init__(self, size: int):
+        self._size = size
+        self._lock = threading.Lock()
+        self._idle: Dict[str, List[sqlite3.Connection]] = {}
+        self._closed = False
+        self._local = threading.local()
+
+    @contextmanager
+    def connection(self, path: str):
+        held: Dict[str, Tuple[sqlite3.Connection, int]] = self._local.__dict__.setdefault("held", {})
+        if path in held:
+            conn, depth = held[path]
+            held[path] = (conn, depth + 1)
+            try:
+                yield conn
+            finally:
+                held[path] = (conn, depth)
+            return
+
+        with self._lock:
+            idle = self._idle.get(path)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            conn = connect(path)
+        held[path] = (conn, 0)
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            del held[path]
+            self._release(path, conn)
+
+    def _release(self, path: str, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(path, [])
+            if not self._closed and len(idle) < self._size:
+                idle.append(conn)
+                return
         conn.close()
 
+    def close_all(self) -> None:
+        """Closes idle connections; connections in use are closed when released"""
+        with self._lock:
+            self._closed = True
+            connections = [conn for idle in self._idle.values() for conn in idle]
+            self._idle.clear()
+        for conn in connections:
+            conn.close()
 
-def init_db() -> None:
-    with open_db() as conn:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_user_id INTEGER PRIMARY KEY,
-                reward_per_dep REAL NOT NULL DEFAULT 0,
-                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
-            );
-            """
-        )
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS events (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_user_id INTEGER NOT NULL,
-                event_type TEXT NOT NULL CHECK(event_type IN ('registration','first_dep')),
-                played_id TEXT,
-                btag TEXT,
-                campaign_id TEXT,
-                reward_snapshot REAL, -- only for first_dep
-                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (telegram_user_id) REFERENCES users(telegram_user_id)
-            );
-            """
+
+_pool = _ConnectionPool(DB_POOL_SIZE)
+
+
+def sharded_path(path: str, shard: int, shards: int = DB_SHARDS) -> str:
+    """The file of one shard: the path itself when unsharded, else data.sqlite3 -> data.2.sqlite3"""
+    if shards == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{shard}{ext}"
+
+
+def shard_of(telegram_user_id: int, shards: int = DB_SHARDS) -> int:
+    """Shard holding all rows of a partner; the same rule as reshard.py uses in SQL"""
+    return telegram_user_id % shards
+
+
+def shard_paths() -> List[str]:
+    """Database files of all shards, in shard order"""
+    return [sharded_path(DB_PATH, shard, DB_SHARDS) for shard in range(DB_SHARDS)]
+
+
+def user_db_path(telegram_user_id: int) -> str:
+    return sharded_path(DB_PATH, shard_of(telegram_user_id, DB_SHARDS), DB_SHARDS)
+
+
+@contextmanager
+def open_db(path: Optional[str] = None):
+    if path is None:
+        if DB_SHARDS != 1:
+            raise ValueError("open_db() needs a shard path when DB_SHARDS > 1")
+        path = DB_PATH
+    with _pool.connection(path) as conn:
+        yield conn
+
+
+@contextmanager
+def open_user_db(telegram_user_id: int):
+    """Connection to the shard of the partner"""
+    with _pool.connection(user_db_path(telegram_user_id)) as conn:
+        yield conn
+
+
+def close_db() -> None:
+    _pool.close_all()
+
+
+def _migration_base_schema(conn: sqlite3.Connection) -> None:
+    cur = conn.cursor()
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_user_id INTEGER PRIMARY KEY,
+            reward_per_dep REAL NOT NULL DEFAULT 0,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_user_id INTEGER NOT NULL,
+            event_type TEXT NOT NULL CHECK(event_type IN ('registration','first_dep')),
+            played_id TEXT,
+            btag TEXT,
+            campaign_id TEXT,
+            reward_snapshot REAL, -- only for first_dep
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (telegram_user_id) REFERENCES users(telegram_user_id)
+        );
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS campaign_rewards (
+            telegram_user_id INTEGER NOT NULL,
+            campaign_id TEXT NOT NULL,
+            reward_per_dep REAL NOT NULL DEFAULT 0,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (telegram_user_id, campaign_id),
+            FOREIGN KEY (telegram_user_id) REFERENCES users(telegram_user_id)
+        );
+        """
+    )
+    # Add campaign_id column if it doesn't exist (for databases created before it was introduced)
+    cur.execute("PRAGMA table_info(events)")
+    columns = [row[1] for row in cur.fetchall()]
+    if 'campaign_id' not in columns:
+        cur.execute("ALTER TABLE events ADD COLUMN campaign_id TEXT")
+
+
+def _register_backfill(conn: sqlite3.Connection, name: str) -> None:
+    """
+    Queues the backfill `name` of BACKFILLS for run_backfills(), fixing its upper bound to the
+    current last event id. Called inside the transaction of the migration step that installs
+    the insert path (e.g. a trigger) taking over after that bound, so no row is missed or counted twice.
+    """
+    conn.execute(
+        "INSERT OR IGNORE INTO meta (key, value) VALUES (?, (SELECT COALESCE(MAX(id), 0) FROM events))",
+        (f"backfill:{name}:high",),
+    )
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, 0)", (f"backfill:{name}:position",))
+
+
+def _migration_meta(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value
         )
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS campaign_rewards (
-                telegram_user_id INTEGER NOT NULL,
-                campaign_id TEXT NOT NULL,
-                reward_per_dep REAL NOT NULL DEFAULT 0,
-                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (telegram_user_id, campaign_id),
-                FOREIGN KEY (telegram_user_id) REFERENCES users(telegram_user_id)
-            );
-            """
+        """
+    )
+
+
+def _migration_hourly_rollups(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS event_rollups_hourly (
+            telegram_user_id INTEGER NOT NULL,
+            hour_ts INTEGER NOT NULL, -- UTC epoch seconds of the hour start
+            campaign_id TEXT NOT NULL,
+            btag TEXT NOT NULL,
+            reg_count INTEGER NOT NULL DEFAULT 0,
+            dep_count INTEGER NOT NULL DEFAULT 0,
+            reward_sum REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (telegram_user_id, hour_ts, campaign_id, btag)
+        ) WITHOUT ROWID
+        """
+    )
+    # Maintained in the inserting transaction, so every committed event is counted exactly once
+    # (and an ignored duplicate insert is not counted at all); older events are added by the backfill
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_events_rollup_hourly AFTER INSERT ON events
+        BEGIN
+            INSERT INTO event_rollups_hourly
+                (telegram_user_id, hour_ts, campaign_id, btag, reg_count, dep_count, reward_sum)
+            VALUES (
+                NEW.telegram_user_id,
+                CAST(strftime('%s', NEW.created_at) AS INTEGER) / 3600 * 3600,
+                COALESCE(NEW.campaign_id, ''),
+                COALESCE(NEW.btag, ''),
+                NEW.event_type = 'registration',
+                NEW.event_type = 'first_dep',
+                CASE WHEN NEW.event_type = 'first_dep' THEN COALESCE(NEW.reward_snapshot, 0) ELSE 0 END
+            )
+            ON CONFLICT (telegram_user_id, hour_ts, campaign_id, btag) DO UPDATE SET
+                reg_count = reg_count + excluded.reg_count,
+                dep_count = dep_count + excluded.dep_count,
+                reward_sum = reward_sum + excluded.reward_sum;
+        END
+        """
+    )
+    _register_backfill(conn, "event_rollups_hourly")
+
+
+def _migration_rollups_hour_index(conn: sqlite3.Connection) -> None:
+    # Queues the build of idx_rollups_hour, which serves the bulk hourly report's cross-user
+    # scans of a time range; the rollup table can be large, so it is built in the background
+    _register_backfill(conn, "rollups_hour_index")
+
+
+def _migration_unique_player(conn: sqlite3.Connection) -> None:
+    # Postbacks used to be stored with a '-' placeholder instead of the player id;
+    # the unique index on the player id is built once the placeholders are gone
+    _register_backfill(conn, "played_id_placeholder")
+
+
+def _create_created_ts_trigger(conn: sqlite3.Connection) -> None:
+    # Fills created_ts for rows inserted without it (code from before the column, or created_at
+    # left to its default), so no row is missed between the backfill bound and the new writers
+    conn.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_events_created_ts AFTER INSERT ON events
+        WHEN NEW.created_ts IS NULL
+        BEGIN
+            UPDATE events SET created_ts = CAST(strftime('%s', NEW.created_at) AS INTEGER) WHERE id = NEW.id;
+        END
+        """
+    )
+
+
+def _migration_created_ts(conn: sqlite3.Connection) -> None:
+    # Integer epoch seconds next to the text created_at: range filters compare integers
+    # and the time indexes store 8-byte keys instead of 19-character strings
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(events)")]
+    if "created_ts" not in columns:
+        conn.execute("ALTER TABLE events ADD COLUMN created_ts INTEGER")
+    _create_created_ts_trigger(conn)
+    conn.execute("DROP TRIGGER IF EXISTS trg_events_rollup_hourly")
+    conn.execute(
+        """
+        CREATE TRIGGER trg_events_rollup_hourly AFTER INSERT ON events
+        BEGIN
+            INSERT INTO event_rollups_hourly
+                (telegram_user_id, hour_ts, campaign_id, btag, reg_count, dep_count, reward_sum)
+            VALUES (
+                NEW.telegram_user_id,
+                COALESCE(NEW.created_ts, CAST(strftime('%s', NEW.created_at) AS INTEGER)) / 3600 * 3600,
+                COALESCE(NEW.campaign_id, ''),
+                COALESCE(NEW.btag, ''),
+                NEW.event_type = 'registration',
+                NEW.event_type = 'first_dep',
+                CASE WHEN NEW.event_type = 'first_dep' THEN COALESCE(NEW.reward_snapshot, 0) ELSE 0 END
+            )
+            ON CONFLICT (telegram_user_id, hour_ts, campaign_id, btag) DO UPDATE SET
+                reg_count = reg_count + excluded.reg_count,
+                dep_count = dep_count + excluded.dep_count,
+                reward_sum = reward_sum + excluded.reward_sum;
+        END
+        """
+    )
+    _register_backfill(conn, "created_ts")
+
+
+def _migration_report_runs(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS report_runs (
+            telegram_user_id INTEGER PRIMARY KEY,
+            hour_ts INTEGER NOT NULL
         )
-        # Add campaign_id column if it doesn't exist (for existing databases)
-        cur.execute(
-            """
-            SELECT name FROM sqlite_master 
-            WHERE type='table' AND name='events'
+        """
+    )
+
+
+# Schema migrations, applied in order. PRAGMA user_version holds the number of applied ones,
+# so never reorder or remove entries, only append. Steps only change the schema (tables, columns,
+# triggers) and stay quick; work proportional to the data goes to BACKFILLS.
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _migration_base_schema,
+    _migration_meta,
+    _migration_hourly_rollups,
+    _migration_rollups_hour_index,
+    _migration_unique_player,
+    _migration_created_ts,
+    _migration_report_runs,
+]
+
+
+def _remove_duplicate_players(conn: sqlite3.Connection) -> None:
+    # Retries stored while the unique index didn't exist yet: keep the first event of each player
+    # and take the others back out of the rollups before deleting them
+    duplicates = conn.execute(
+        """
+        SELECT e.id, e.telegram_user_id, e.event_type, e.campaign_id, e.btag, e.reward_snapshot,
+               COALESCE(e.created_ts, CAST(strftime('%s', e.created_at) AS INTEGER)) / 3600 * 3600 AS hour_ts
+        FROM events e
+        JOIN (
+            SELECT telegram_user_id, event_type, played_id, MIN(id) AS first_id
+            FROM events
+            WHERE played_id IS NOT NULL
+            GROUP BY telegram_user_id, event_type, played_id
+            HAVING COUNT(*) > 1
+        ) d ON e.telegram_user_id = d.telegram_user_id AND e.event_type = d.event_type
+           AND e.played_id = d.played_id AND e.id > d.first_id
+        """
+    ).fetchall()
+    for row in duplicates:
+        is_dep = row["event_type"] == "first_dep"
+        conn.execute(
             """
+            UPDATE event_rollups_hourly
+            SET reg_count = reg_count - ?, dep_count = dep_count - ?, reward_sum = reward_sum - ?
+            WHERE telegram_user_id = ? AND hour_ts = ? AND campaign_id = ? AND btag = ?
+            """,
+            (
+                int(not is_dep), int(is_dep), (row["reward_snapshot"] or 0) if is_dep else 0,
+                row["telegram_user_id"], row["hour_ts"], row["campaign_id"] or "", row["btag"] or "",
+            ),
         )
-        if cur.fetchone():
-            # Check if campaign_id column exists
-            cur.execute("PRAGMA table_info(events)")
-            columns = [row[1] for row in cur.fetchall()]
-            if 'campaign_id' not in columns:
-                cur.execute("ALTER TABLE events ADD COLUMN campaign_id TEXT")
+        conn.execute("DELETE FROM events WHERE id = ?", (row["id"],))
+    if duplicates:
+        logger.warning(f"Удалено повторных событий игроков: {len(duplicates)}")
+
+
+def _finish_unique_player(conn: sqlite3.Connection) -> None:
+    _remove_duplicate_players(conn)
+    # A retried postback for the same player is stored once; events without a player id can't be matched
+    conn.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_events_player
+        ON events (telegram_user_id, event_type, played_id)
+        WHERE played_id IS NOT NULL
+        """
+    )
+
+
+def _finish_rollups_hour_index(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_rollups_hour
+        ON event_rollups_hourly (hour_ts, telegram_user_id, campaign_id, btag, reg_count, dep_count, reward_sum)
+        """
+    )
+
+
+def _finish_created_ts(conn: sqlite3.Connection) -> None:
+    # idx_events_user_type_ts covers the per-partner period aggregates (equality on user and type,
+    # range on created_ts, grouped and summed columns), so they never touch the table itself;
+    # idx_events_ts serves the cross-user load of the hour window. Both are built
+    # once every row has created_ts, which is cheaper than updating them row by row
+    conn.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_events_user_type_ts
+        ON events (telegram_user_id, event_type, created_ts, campaign_id, btag, reward_snapshot)
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_ts ON events (created_ts)")
+
+
+class _Backfill(NamedTuple):
+    name: str
+    # Run with (first_id, last_id) over the events that existed when the backfill was registered
+    sql: Optional[str]
+    # Run once after the last chunk, in the transaction that marks the backfill done
+    finish: Optional[Callable[[sqlite3.Connection], None]] = None
+
+
+# Data migrations registered by MIGRATIONS steps, run in this order by run_backfills()
+# in the background while postbacks are being accepted
+BACKFILLS: List[_Backfill] = [
+    _Backfill(
+        "event_rollups_hourly",
+        """
+        INSERT INTO event_rollups_hourly
+            (telegram_user_id, hour_ts, campaign_id, btag, reg_count, dep_count, reward_sum)
+        SELECT telegram_user_id,
+               CAST(strftime('%s', created_at) AS INTEGER) / 3600 * 3600 AS hour_ts,
+               COALESCE(campaign_id, '') AS campaign,
+               COALESCE(btag, '') AS tag,
+               SUM(event_type = 'registration'),
+               SUM(event_type = 'first_dep'),
+               SUM(CASE WHEN event_type = 'first_dep' THEN COALESCE(reward_snapshot, 0) ELSE 0 END)
+        FROM events
+        WHERE id BETWEEN ? AND ?
+        GROUP BY telegram_user_id, hour_ts, campaign, tag
+        ON CONFLICT (telegram_user_id, hour_ts, campaign_id, btag) DO UPDATE SET
+            reg_count = reg_count + excluded.reg_count,
+            dep_count = dep_count + excluded.dep_count,
+            reward_sum = reward_sum + excluded.reward_sum
+        """,
+    ),
+    _Backfill("rollups_hour_index", None, _finish_rollups_hour_index),
+    _Backfill(
+        "played_id_placeholder",
+        "UPDATE events SET played_id = NULL WHERE id BETWEEN ? AND ? AND played_id = '-'",
+        _finish_unique_player,
+    ),
+    _Backfill(
+        "created_ts",
+        """
+        UPDATE events SET created_ts = CAST(strftime('%s', created_at) AS INTEGER)
+        WHERE id BETWEEN ? AND ? AND created_ts IS NULL
+        """,
+        _finish_created_ts,
+    ),
+]
+
+
+# Database files this process has already brought up to date; later init_db() calls skip them
+_checked_paths: Set[str] = set()
+
+
+def init_db(paths: Optional[List[str]] = None) -> None:
+    """
+    Applies pending MIGRATIONS to every shard (or to the given database files).
+    Each file is checked once per process: an up-to-date schema costs one PRAGMA user_version.
+    Backfills the steps register are left to run_backfills()/start_backfills().
+    """
+    for path in paths or shard_paths():
+        if path not in _checked_paths:
+            _migrate(path)
+            _checked_paths.add(path)
+
+
+def _migrate(path: str) -> None:
+    with open_db(path) as conn:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+            return
+        conn.commit()
+        for target in range(1, len(MIGRATIONS) + 1):
+            # Each step runs in one transaction under the write lock, after re-checking the
+            # version, so processes starting together apply every step exactly once
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= target:
+                conn.rollback()
+                continue
+            migration = MIGRATIONS[target - 1]
+            logger.info(f"Миграция базы данных {path} {target}/{len(MIGRATIONS)}: {migration.__name__}")
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        if conn.execute("SELECT 1 FROM events LIMIT 1").fetchone() is None:
+            # Nothing to backfill in a new database: build its indexes right away
+            for backfill in BACKFILLS:
+                _run_backfill(conn, path, backfill)
+        conn.execute("PRAGMA optimize")
+
+
+def _meta_value(conn: sqlite3.Connection, key: str) -> Optional[int]:
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return None if row is None else int(row[0])
+
+
+def _run_backfill(conn: sqlite3.Connection, path: str, backfill: _Backfill) -> bool:
+    """
+    Runs a registered backfill to its end, committing every MIGRATION_CHUNK_SIZE ids so postback
+    writes interleave with it. Progress is kept in meta, so an interrupted backfill resumes where it
+    stopped and several processes can share one; a done marker makes it a no-op afterwards.
+    Returns whether this call did any work.
+    """
+    position_key = f"backfill:{backfill.name}:position"
+    high_key = f"backfill:{backfill.name}:high"
+    done_key = f"backfill:{backfill.name}:done"
+    position = _meta_value(conn, position_key)
+    if position is None or _meta_value(conn, done_key) is not None:
+        return False
+    # Index-only steps and empty ranges finish at once and are not worth a log line
+    logged = backfill.sql is not None and (_meta_value(conn, high_key) or 0) > position
+    if logged:
+        logger.info(f"Заполнение данных {backfill.name} в {path}")
+    started = time.monotonic()
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        if _meta_value(conn, done_key) is not None:
+            conn.rollback()
+            return True
+        position, high = _meta_value(conn, position_key) or 0, _meta_value(conn, high_key) or 0
+        if backfill.sql is None or position >= high:
+            if backfill.finish is not None:
+                backfill.finish(conn)
+            conn.execute("INSERT INTO meta (key, value) VALUES (?, 1)", (done_key,))
+            conn.commit()
+            if logged:
+                logger.info(f"Заполнение данных {backfill.name} в {path} завершено за {time.monotonic() - started:.1f} с")
+            return True
+        last_id = min(position + MIGRATION_CHUNK_SIZE, high)
+        conn.execute(backfill.sql, (position + 1, last_id))
+        conn.execute("UPDATE meta SET value = ? WHERE key = ?", (last_id, position_key))
+        conn.commit()
+
+
+def run_backfills(paths: Optional[List[str]] = None) -> None:
+    """Runs the pending BACKFILLS of every shard (or of the given files); init_db() must have run"""
+    for path in paths or shard_paths():
+        with open_db(path) as conn:
+            conn.commit()
+            for backfill in BACKFILLS:
+                _run_backfill(conn, path, backfill)
+            conn.execute("PRAGMA optimize")
+
+
+_backfill_thread: Optional[threading.Thread] = None
+
+
+def start_backfills() -> None:
+    """
+    Runs the pending backfills in a background thread, once per process. Called once the process
+    accepts postbacks: until they finish, reports may miss events stored before the upgrade.
+    """
+    global _backfill_thread
+    if _backfill_thread is not None:
+        return
+
+    def run() -> None:
+        try:
+            run_backfills()
+        except Exception as e:
+            logger.error(f"Ошибка фонового заполнения данных: {e}", exc_info=True)
+
+    _backfill_thread = threading.Thread(target=run, name="db-backfill", daemon=True)
+    _backfill_thread.start()
+
+
+class _RewardCache:
+    """
+    In-process copy of users.reward_per_dep and campaign_rewards, loaded per user on first use.
+    set_reward/set_campaign_reward invalidate the user's entry after their commit, and a load
+    that raced with such an invalidation is discarded, so the cache never keeps a stale rate.
+    Rates changed by another process are noticed through the reward revision in meta (sync()).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[int, Tuple[float, Dict[str, float]]] = {}
+        self._generations: Dict[int, int] = {}
+        # Bumped by sync() when it drops every entry
+        self._epoch = 0
+        self._revisions: Dict[str, int] = {}
+
+    def get(self, telegram_user_id: int) -> Optional[Tuple[float, Dict[str, float]]]:
+        with self._lock:
+            return self._entries.get(telegram_user_id)
+
+    def generation(self, telegram_user_id: int) -> Tuple[int, int]:
+        with self._lock:
+            return self._epoch, self._generations.get(telegram_user_id, 0)
+
+    def put(self, telegram_user_id: int, generation: Tuple[int, int], entry: Tuple[float, Dict[str, float]]) -> None:
+        with self._lock:
+            if (self._epoch, self._generations.get(telegram_user_id, 0)) == generation:
+                self._entries[telegram_user_id] = entry
+
+    def invalidate(self, telegram_user_id: int) -> None:
+        with self._lock:
+            self._entries.pop(telegram_user_id, None)
+            self._generations[telegram_user_id] = self._generations.get(telegram_user_id, 0) + 1
+
+    def sync(self, path: str, revision: int) -> None:
+        """Drops all entries if the reward revision of the database file changed since the last sync"""
+        with self._lock:
+            if self._revisions.get(path) == revision:
+                return
+            self._revisions[path] = revision
+            self._entries.clear()
+            self._epoch += 1
+
+
+_reward_cache = _RewardCache()
+
+
+def _user_rewards(conn: sqlite3.Connection, telegram_user_id: int) -> Tuple[float, Dict[str, float]]:
+    """Returns (default reward, campaign rewards) for a user, creating the user row if needed"""
+    entry = _reward_cache.get(telegram_user_id)
+    if entry is not None:
+        return entry
+    generation = _reward_cache.generation(telegram_user_id)
+    conn.execute(
+        "INSERT OR IGNORE INTO users (telegram_user_id, reward_per_dep) VALUES (?, ?)",
+        (telegram_user_id, DEFAULT_REWARD_PER_DEP),
+    )
+    row = conn.execute(
+        "SELECT reward_per_dep FROM users WHERE telegram_user_id = ?",
+        (telegram_user_id,),
+    ).fetchone()
+    rows = conn.execute(
+        "SELECT campaign_id, reward_per_dep FROM campaign_rewards WHERE telegram_user_id = ?",
+        (telegram_user_id,),
+    ).fetchall()
+    entry = (float(row[0]) if row else 0.0, {r["campaign_id"]: float(r["reward_per_dep"]) for r in rows})
+    _reward_cache.put(telegram_user_id, generation, entry)
+    return entry
+
+
+def _bump_reward_revision(conn: sqlite3.Connection) -> None:
+    # In the transaction that changes a rate, so other processes see both at once
+    conn.execute(
+        """
+        INSERT INTO meta (key, value) VALUES ('reward_revision', 1)
+        ON CONFLICT (key) DO UPDATE SET value = value + 1
+        """
+    )
+
+
+def _sync_reward_cache(conn: sqlite3.Connection, path: str) -> None:
+    """Before snapshotting rewards: forget cached rates if another process (e.g. the bot) changed any"""
+    row = conn.execute("SELECT value FROM meta WHERE key = 'reward_revision'").fetchone()
+    _reward_cache.sync(path, int(row[0]) if row else 0)
+
+
+def _resolve_reward(conn: sqlite3.Connection, telegram_user_id: int, campaign_id: Optional[str]) -> float:
+    """Campaign-specific reward if set, otherwise the user's default reward"""
+    default_reward, campaign_rewards = _user_rewards(conn, telegram_user_id)
+    if campaign_id and campaign_id in campaign_rewards:
+        return campaign_rewards[campaign_id]
+    return default_reward
 
 
 def ensure_user(telegram_user_id: int) -> None:
-    with open_db() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT telegram_user_id FROM users WHERE telegram_user_id = ?", (telegram_user_id,))
-        if cur.fetchone() is None:
-            cur.execute(
-                "INSERT INTO users (telegram_user_id, reward_per_dep) VALUES (?, ?)",
-                (telegram_user_id, DEFAULT_REWARD_PER_DEP),
-            )
+    if _reward_cache.get(telegram_user_id) is not None:
+        return
+    with open_user_db(telegram_user_id) as conn:
+        _user_rewards(conn, telegram_user_id)
 
 
 def set_reward(telegram_user_id: int, amount: float) -> None:
-    ensure_user(telegram_user_id)
-    with open_db() as conn:
+    with open_user_db(telegram_user_id) as conn:
         conn.execute(
-            "UPDATE users SET reward_per_dep = ? WHERE telegram_user_id = ?",
-            (amount, telegram_user_id),
+            """
+            INSERT INTO users (telegram_user_id, reward_per_dep) VALUES (?, ?)
+            ON CONFLICT(telegram_user_id) DO UPDATE SET reward_per_dep = excluded.reward_per_dep
+            """,
+            (telegram_user_id, amount),
         )
+        _bump_reward_revision(conn)
+    _reward_cache.invalidate(telegram_user_id)
 
 
 def get_reward(telegram_user_id: int) -> float:
-    ensure_user(telegram_user_id)
-    with open_db() as conn:
-        row = conn.execute(
-            "SELECT reward_per_dep FROM users WHERE telegram_user_id = ?",
-            (telegram_user_id,),
-        ).fetchone()
-        print(bool(row))
-        print(float(row[0]) if row else 0.0)
-        return float(row[0]) if row else 0.0
+    with open_user_db(telegram_user_id) as conn:
+        return _user_rewards(conn, telegram_user_id)[0]
 
 
 def get_campaign_reward(telegram_user_id: int, campaign_id: Optional[str]) -> Optional[float]:
     """Returns campaign-specific reward if set, None otherwise"""
     if not campaign_id:
         return None
-    ensure_user(telegram_user_id)
-    with open_db() as conn:
-        row = conn.execute(
-            "SELECT reward_per_dep FROM campaign_rewards WHERE telegram_user_id = ? AND campaign_id = ?",
-            (telegram_user_id, campaign_id),
-        ).fetchone()
-        return float(row[0]) if row else None
+    with open_user_db(telegram_user_id) as conn:
+        return _user_rewards(conn, telegram_user_id)[1].get(campaign_id)
 
 
 def set_campaign_reward(telegram_user_id: int, campaign_id: str, amount: float) -> None:
     """Set reward per deposit for a specific campaign"""
-    ensure_user(telegram_user_id)
-    with open_db() as conn:
+    with open_user_db(telegram_user_id) as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO users (telegram_user_id, reward_per_dep) VALUES (?, ?)",
+            (telegram_user_id, DEFAULT_REWARD_PER_DEP),
+        )
         conn.execute(
             """
             INSERT INTO campaign_rewards (telegram_user_id, campaign_id, reward_per_dep, updated_at)
@@ -133,17 +744,42 @@ def set_campaign_reward(telegram_user_id: int, campaign_id: str, amount: float)
             """,
             (telegram_user_id, campaign_id, amount, amount),
         )
+        _bump_reward_revision(conn)
+    _reward_cache.invalidate(telegram_user_id)
 
 
 def get_all_campaign_rewards(telegram_user_id: int) -> Dict[str, float]:
     """Get all campaign rewards for a user"""
-    ensure_user(telegram_user_id)
-    with open_db() as conn:
-        rows = conn.execute(
-            "SELECT campaign_id, reward_per_dep FROM campaign_rewards WHERE telegram_user_id = ?",
-            (telegram_user_id,),
-        ).fetchall()
-        return {row["campaign_id"]: float(row["reward_per_dep"]) for row in rows}
+    with open_user_db(telegram_user_id) as conn:
+        return dict(_user_rewards(conn, telegram_user_id)[1])
+
+
+# Rolling "hour" per user in minute buckets, fed by inserts after their commit.
+# Only consulted once enable_hour_window() was called, i.e. when ingestion runs in this process
+hour_window = MinuteWindow(60)
+
+
+def enable_hour_window() -> None:
+    """Loads the last hour of events into hour_window and answers the "hour" period from it"""
+    start, _ = _epoch_range(_period_bounds("hour"))
+    rows: List[sqlite3.Row] = []
+    for path in shard_paths():
+        with open_db(path) as conn:
+            rows.extend(conn.execute(
+                """
+                SELECT telegram_user_id, event_type, campaign_id, btag, reward_snapshot, created_at
+                FROM events
+                WHERE created_ts >= ?
+                """,
+                (start,),
+            ))
+    hour_window.activate(tuple(row) for row in rows)
+    logger.info(f"Окно последнего часа загружено: {len(rows)} событий")
+
+
+def _window_hour(telegram_user_id: int, now: Optional[datetime] = None) -> PeriodStats:
+    stats, totals = hour_window.stats(telegram_user_id, now or datetime.utcnow())
+    return PeriodStats(stats, totals)
 
 
 def insert_event(
@@ -152,29 +788,94 @@ def insert_event(
     played_id: Optional[str],
     btag: Optional[str],
     campaign_id: Optional[str] = None,
-) -> None:
-    ensure_user(telegram_user_id)
-    reward_snapshot: Optional[float] = None
-    if event_type == "first_dep":
-        # snapshot the reward at the time of first deposit
-        # Use campaign-specific reward if available, otherwise use default reward
-        campaign_reward = get_campaign_reward(telegram_user_id, campaign_id)
-        reward_snapshot = campaign_reward if campaign_reward is not None else get_reward(telegram_user_id)
-    with open_db() as conn:
-        conn.execute(
+) -> bool:
+    """Returns False if the event is a duplicate of an already stored (user, type, player) postback"""
+    created_at = datetime.utcnow().replace(microsecond=0)
+    path = user_db_path(telegram_user_id)
+    with open_db(path) as conn:
+        _sync_reward_cache(conn, path)
+        reward_snapshot: Optional[float] = None
+        if event_type == "first_dep":
+            # snapshot the reward at the time of first deposit
+            # Use campaign-specific reward if available, otherwise use default reward
+            reward_snapshot = _resolve_reward(conn, telegram_user_id, campaign_id)
+        else:
+            _user_rewards(conn, telegram_user_id)
+        cur = conn.execute(
             """
-            INSERT INTO events (telegram_user_id, event_type, played_id, btag, campaign_id, reward_snapshot)
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT OR IGNORE INTO events
+                (telegram_user_id, event_type, played_id, btag, campaign_id, reward_snapshot, created_at, created_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             """,
-            (telegram_user_id, event_type, played_id, btag, campaign_id, reward_snapshot),
+            (telegram_user_id, event_type, played_id, btag, campaign_id, reward_snapshot, created_at,
+             int(_epoch(created_at))),
         )
+        stored = cur.rowcount > 0
+    if stored:
+        hour_window.add(telegram_user_id, event_type, campaign_id, btag, reward_snapshot, created_at)
+    return stored
 
 
-def _period_bounds(period: str) -> Optional[Tuple[datetime, datetime]]:
-    now = datetime.utcnow()
+def insert_events(
+    events: List[Tuple[int, str, Optional[str], Optional[str], Optional[str], datetime]],
+) -> List[bool]:
+    """
+    Inserts a batch of events in a single transaction per shard.
+    Each event is (telegram_user_id, event_type, played_id, btag, campaign_id, created_at).
+    Returns for each event whether it was stored (False for a duplicate postback).
+    """
+    by_shard: Dict[int, List[int]] = {}
+    for index, event in enumerate(events):
+        by_shard.setdefault(shard_of(event[0], DB_SHARDS), []).append(index)
+    inserted = [False] * len(events)
+    for shard, indexes in by_shard.items():
+        path = sharded_path(DB_PATH, shard, DB_SHARDS)
+        for index, stored in zip(indexes, _insert_shard_events(path, [events[index] for index in indexes])):
+            inserted[index] = stored
+    return inserted
+
+
+def _insert_shard_events(
+    path: str,
+    events: List[Tuple[int, str, Optional[str], Optional[str], Optional[str], datetime]],
+) -> List[bool]:
+    inserted: List[bool] = []
+    if not events:
+        return inserted
+    stored = []
+    with open_db(path) as conn:
+        _sync_reward_cache(conn, path)
+        for telegram_user_id, event_type, played_id, btag, campaign_id, created_at in events:
+            reward_snapshot: Optional[float] = None
+            if event_type == "first_dep":
+                reward_snapshot = _resolve_reward(conn, telegram_user_id, campaign_id)
+            else:
+                _user_rewards(conn, telegram_user_id)
+            # Row by row rather than executemany to learn which rows the unique key ignored;
+            # the statement is cached and all rows still share one commit
+            cur = conn.execute(
+                """
+                INSERT OR IGNORE INTO events
+                    (telegram_user_id, event_type, played_id, btag, campaign_id, reward_snapshot, created_at, created_ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (telegram_user_id, event_type, played_id, btag, campaign_id, reward_snapshot, created_at,
+                 int(_epoch(created_at))),
+            )
+            inserted.append(cur.rowcount > 0)
+            if cur.rowcount > 0:
+                stored.append((telegram_user_id, event_type, campaign_id, btag, reward_snapshot, created_at))
+    # Only after the commit, so the window never counts rolled back events
+    for event in stored:
+        hour_window.add(*event)
+    return inserted
+
+
+def _period_bounds(period: str, now: Optional[datetime] = None) -> Optional[Tuple[datetime, datetime]]:
+    now = now or datetime.utcnow()
     if period == "hour":
-        # Прошедший час (от часа назад до сейчас)
-        hour_start = now - timedelta(hours=1)
+        # Прошедший час (от часа назад до сейчас), с начала минуты — как в hour_window
+        hour_start = now.replace(second=0, microsecond=0) - timedelta(hours=1)
         return (hour_start, now)
     if period == "day":
         # Сегодня (от начала дня до сейчас)
@@ -199,6 +900,7 @@ def _period_bounds(period: str) -> Optional[Tuple[datetime, datetime]]:
     return None  # all time
 
 
+@timed(DB_QUERY_SECONDS, "aggregate_by_btag")
 def aggregate_by_btag(telegram_user_id: int, period: str) -> Dict[str, Tuple[int, int, float]]:
     """
     Returns mapping: btag -> (registrations_count, first_deposits_count, total_reward_sum)
@@ -209,9 +911,8 @@ def aggregate_by_btag(telegram_user_id: int, period: str) -> Dict[str, Tuple[int
     params = [telegram_user_id]
     time_filter = ""
     if period_bounds is not None:
-        time_filter = " AND created_at >= ? AND created_at <= ?"
-        params.append(period_bounds[0])
-        params.append(period_bounds[1])
+        time_filter = " AND created_ts >= ? AND created_ts < ?"
+        params.extend(_epoch_range(period_bounds))
 
     # SQLite doesn't support FULL OUTER JOIN. Emulate via UNION of LEFT JOINs.
     sql_left = f"""
@@ -255,7 +956,7 @@ def aggregate_by_btag(telegram_user_id: int, period: str) -> Dict[str, Tuple[int
     """
 
     results: Dict[str, Tuple[int, int, float]] = {}
-    with open_db() as conn:
+    with open_user_db(telegram_user_id) as conn:
         rows_left = conn.execute(sql_left, params + params).fetchall()
         rows_right = conn.execute(sql_right_only, params + params).fetchall()
         for row in rows_left + rows_right:
@@ -264,66 +965,371 @@ def aggregate_by_btag(telegram_user_id: int, period: str) -> Dict[str, Tuple[int
     return results
 
 
-def aggregate_by_campaign_and_btag(telegram_user_id: int, period: str) -> Dict[str, Dict[str, Tuple[int, int, float]]]:
+def _epoch(moment: datetime) -> float:
+    """UTC epoch seconds of a naive UTC datetime"""
+    return moment.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _epoch_range(period_bounds: Tuple[datetime, datetime]) -> Tuple[int, int]:
+    """
+    The half-open created_ts range of an inclusive period: events have whole-second
+    timestamps, so [start, end] holds exactly the seconds ceil(start) .. floor(end).
+    """
+    start, end = period_bounds
+    return math.ceil(_epoch(start)), math.floor(_epoch(end)) + 1
+
+
+def _split_bounds(
+    period_bounds: Optional[Tuple[datetime, datetime]],
+) -> Tuple[Tuple[Optional[int], Optional[int]], List[Tuple[int, int]]]:
+    """
+    Splits an inclusive period into whole hours answered from event_rollups_hourly,
+    as a half-open hour_ts range (None means unbounded), and the partial edge hours
+    that still have to be read from raw events, as half-open created_ts ranges.
+    """
+    if period_bounds is None:
+        return (None, None), []
+    start, end = _epoch_range(period_bounds)
+    first_hour = -(-start // 3600) * 3600
+    last_hour = end // 3600 * 3600
+    if first_hour >= last_hour:
+        return (0, 0), [(start, end)]
+    raw_ranges = []
+    if start < first_hour:
+        raw_ranges.append((start, first_hour))
+    if last_hour < end:
+        raw_ranges.append((last_hour, end))
+    return (first_hour, last_hour), raw_ranges
+
+
+def _merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    merged: List[Tuple[int, int]] = []
+    for range_start, range_end in sorted(ranges):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+        else:
+            merged.append((range_start, range_end))
+    return merged
+
+
+def _periods_query(
+    periods: List[str],
+    telegram_user_id: Optional[int] = None,
+    page: Optional[Tuple[int, int]] = None,
+    telegram_user_ids: Optional[List[int]] = None,
+) -> Tuple[str, Dict[str, object]]:
+    """
+    Builds one statement aggregating several periods by conditional aggregation.
+    Rows for the union of all periods are read once: whole hours from event_rollups_hourly,
+    partial edge hours from raw events. Without telegram_user_id it covers all users
+    (or those in telegram_user_ids), grouped and ordered by telegram_user_id, with totals per user.
+    With page=(limit, offset) only that slice of (campaign_id, btag) rows is returned, ordered by
+    deposits of the first period, plus row_count; totals still cover all rows.
+    """
+    now = datetime.utcnow()
+    plans = [_split_bounds(_period_bounds(period, now)) for period in periods]
+    params: Dict[str, object] = {}
+    user_filter = ""
+    if telegram_user_id is not None:
+        user_filter = "telegram_user_id = :user AND "
+        params["user"] = telegram_user_id
+    elif telegram_user_ids is not None:
+        # One parameter whatever the number of users, so the statement text stays the same
+        user_filter = "telegram_user_id IN (SELECT value FROM json_each(:users)) AND "
+        params["users"] = json.dumps(telegram_user_ids)
+
+    hour_ranges = [hours for hours, _ in plans if hours != (0, 0)]
+    rollup_filter = ""
+    if hour_ranges and all(first is not None for first, _ in hour_ranges):
+        rollup_filter = "hour_ts >= :hours_from AND hour_ts < :hours_to"
+        params["hours_from"] = min(first for first, _ in hour_ranges)
+        params["hours_to"] = max(last for _, last in hour_ranges)
+    parts = []
+    if hour_ranges:
+        parts.append(
+            f"""
+            SELECT telegram_user_id, hour_ts, NULL AS created_ts, campaign_id, btag, reg_count, dep_count, reward_sum
+            FROM event_rollups_hourly
+            WHERE {user_filter}{rollup_filter or "1"}
+            """
+        )
+    for index, (range_start, range_end) in enumerate(_merge_ranges([r for _, raw in plans for r in raw])):
+        parts.append(
+            f"""
+            SELECT telegram_user_id, NULL AS hour_ts, created_ts,
+                   COALESCE(campaign_id, '') AS campaign_id, COALESCE(btag, '') AS btag,
+                   event_type = 'registration' AS reg_count, event_type = 'first_dep' AS dep_count,
+                   CASE WHEN event_type = 'first_dep' THEN COALESCE(reward_snapshot, 0) ELSE 0 END AS reward_sum
+            FROM events
+            WHERE {user_filter}event_type IN ('registration', 'first_dep')
+              AND created_ts >= :raw{index}_from AND created_ts < :raw{index}_to
+            """
+        )
+        params[f"raw{index}_from"] = range_start
+        params[f"raw{index}_to"] = range_end
+    if not parts:
+        parts.append(
+            "SELECT NULL AS telegram_user_id, NULL AS hour_ts, NULL AS created_ts, '' AS campaign_id, '' AS btag, "
+            "0 AS reg_count, 0 AS dep_count, 0 AS reward_sum WHERE 0"
+        )
+
+    columns = []
+    totals = []
+    partition = "" if telegram_user_id is not None else "PARTITION BY telegram_user_id"
+    for index, ((first_hour, last_hour), raw_ranges) in enumerate(plans):
+        conditions = []
+        if (first_hour, last_hour) != (0, 0):
+            if first_hour is None:
+                conditions.append("hour_ts IS NOT NULL")
+            else:
+                conditions.append(f"hour_ts >= :p{index}_hours_from AND hour_ts < :p{index}_hours_to")
+                params[f"p{index}_hours_from"] = first_hour
+                params[f"p{index}_hours_to"] = last_hour
+        for raw_index, (range_start, range_end) in enumerate(raw_ranges):
+            conditions.append(f"created_ts >= :p{index}_raw{raw_index}_from AND created_ts < :p{index}_raw{raw_index}_to")
+            params[f"p{index}_raw{raw_index}_from"] = range_start
+            params[f"p{index}_raw{raw_index}_to"] = range_end
+        condition = " OR ".join(f"({c})" for c in conditions) or "0"
+        for column in ("reg_count", "dep_count", "reward_sum"):
+            columns.append(f"SUM(CASE WHEN {condition} THEN {column} ELSE 0 END) AS p{index}_{column}")
+            totals.append(f"SUM(p{index}_{column}) OVER ({partition}) AS p{index}_total_{column}")
+    page_columns = ""
+    page_filter = ""
+    order = "ORDER BY telegram_user_id"
+    if page is not None:
+        # Rows with nothing in the first period are not shown, so they must not take a place on
+        # a page or count towards row_count; they add nothing to the totals either
+        page_columns = ", COUNT(*) OVER () AS row_count"
+        page_filter = "WHERE p0_reg_count != 0 OR p0_dep_count != 0"
+        order = "ORDER BY p0_dep_count DESC, p0_reg_count DESC, campaign_id, btag LIMIT :limit OFFSET :offset"
+        params["limit"], params["offset"] = page
+    sql = f"""
+    WITH grouped AS (
+        SELECT telegram_user_id, campaign_id, btag, {", ".join(columns)}
+        FROM ({" UNION ALL ".join(parts)})
+        GROUP BY telegram_user_id, campaign_id, btag
+    )
+    SELECT *, {", ".join(totals)}{page_columns} FROM grouped
+    {page_filter}
+    {order}
+    """
+    return sql, params
+
+
+def _collect_periods(periods: List[str], rows: List[sqlite3.Row]) -> Dict[str, PeriodStats]:
+    """Turns the rows of one user produced by _periods_query into period -> PeriodStats"""
+    results: Dict[str, PeriodStats] = {}
+    for index, period in enumerate(periods):
+        stats: CampaignStats = {}
+        for row in rows:
+            regs, deps = int(row[f"p{index}_reg_count"]), int(row[f"p{index}_dep_count"])
+            if regs or deps:
+                stats.setdefault(row["campaign_id"], {})[row["btag"]] = (
+                    regs, deps, float(row[f"p{index}_reward_sum"])
+                )
+        totals = (0, 0, 0.0)
+        if rows:
+            totals = (
+                int(rows[0][f"p{index}_total_reg_count"]),
+                int(rows[0][f"p{index}_total_dep_count"]),
+                float(rows[0][f"p{index}_total_reward_sum"]),
+            )
+        results[period] = PeriodStats(stats, totals)
+    return results
+
+
+@timed(DB_QUERY_SECONDS, "aggregate_periods")
+def aggregate_periods(telegram_user_id: int, periods: List[str]) -> Dict[str, PeriodStats]:
+    """
+    Aggregates several periods in one pass over the partner's rows.
+    Returns mapping: period -> PeriodStats(stats, totals), where stats is
+    campaign_id -> {btag -> (registrations_count, first_deposits_count, total_reward_sum)}
+    and totals is (registrations_count, first_deposits_count, total_reward_sum) over the period.
+    """
+    if hour_window.active and "hour" in periods:
+        sql_periods = [period for period in periods if period != "hour"]
+        results = aggregate_periods(telegram_user_id, sql_periods) if sql_periods else {}
+        results["hour"] = _window_hour(telegram_user_id)
+        return {period: results[period] for period in periods}
+    sql, params = _periods_query(periods, telegram_user_id)
+    with open_user_db(telegram_user_id) as conn:
+        rows = conn.execute(sql, params).fetchall()
+    return _collect_periods(periods, rows)
+
+
+def iter_periods_for_all_users(
+    periods: List[str], telegram_user_ids: Optional[List[int]] = None,
+) -> Iterator[Tuple[int, Dict[str, PeriodStats]]]:
+    """
+    Same as aggregate_periods for every user with events in the periods, computed by a single
+    statement per shard whose cost doesn't depend on the number of users. Yields (telegram_user_id, stats)
+    in user order while the rows are streamed; users without events are not yielded.
+    telegram_user_ids limits the statement to those users and to the shards holding them.
+    """
+    if hour_window.active and "hour" in periods:
+        yield from _iter_periods_with_window(periods, telegram_user_ids)
+        return
+    if telegram_user_ids is None:
+        paths = shard_paths()
+    else:
+        paths = sorted({user_db_path(telegram_user_id) for telegram_user_id in telegram_user_ids})
+    sql, params = _periods_query(periods, telegram_user_ids=telegram_user_ids)
+    # A generator: time the whole stream rather than its creation
+    with DB_QUERY_SECONDS.time("iter_periods_for_all_users"):
+        # A partner lives in one shard, so merging the per-shard streams keeps every user whole
+        yield from heapq.merge(
+            *(_iter_shard_periods(path, periods, sql, params) for path in paths),
+            key=lambda item: item[0],
+        )
+
+
+def _iter_shard_periods(
+    path: str, periods: List[str], sql: str, params: Dict[str, object],
+) -> Iterator[Tuple[int, Dict[str, PeriodStats]]]:
+    with open_db(path) as conn:
+        current_user: Optional[int] = None
+        user_rows: List[sqlite3.Row] = []
+        for row in conn.execute(sql, params):
+            if row["telegram_user_id"] != current_user:
+                if user_rows:
+                    yield current_user, _collect_periods(periods, user_rows)
+                current_user = row["telegram_user_id"]
+                user_rows = []
+            user_rows.append(row)
+        if user_rows:
+            yield current_user, _collect_periods(periods, user_rows)
+
+
+def _iter_periods_with_window(
+    periods: List[str], telegram_user_ids: Optional[List[int]] = None,
+) -> Iterator[Tuple[int, Dict[str, PeriodStats]]]:
+    # The other periods come from the statement, "hour" from hour_window; both are in user order
+    now = datetime.utcnow()
+    sql_periods = [period for period in periods if period != "hour"]
+    empty = {period: PeriodStats({}, (0, 0, 0.0)) for period in sql_periods}
+    sql_users = iter_periods_for_all_users(sql_periods, telegram_user_ids) if sql_periods else iter(())
+    window_users = hour_window.users(now)
+    if telegram_user_ids is not None:
+        wanted = set(telegram_user_ids)
+        window_users = [telegram_user_id for telegram_user_id in window_users if telegram_user_id in wanted]
+
+    def with_hour(telegram_user_id: int, results: Dict[str, PeriodStats]) -> Dict[str, PeriodStats]:
+        results = dict(results, hour=_window_hour(telegram_user_id, now))
+        return {period: results[period] for period in periods}
+
+    position = 0
+    for telegram_user_id, results in sql_users:
+        while position < len(window_users) and window_users[position] < telegram_user_id:
+            yield window_users[position], with_hour(window_users[position], empty)
+            position += 1
+        if position < len(window_users) and window_users[position] == telegram_user_id:
+            position += 1
+        yield telegram_user_id, with_hour(telegram_user_id, results)
+    for telegram_user_id in window_users[position:]:
+        yield telegram_user_id, with_hour(telegram_user_id, empty)
+
+
+@timed(DB_QUERY_SECONDS, "aggregate_page")
+def aggregate_page(telegram_user_id: int, period: str, limit: int, offset: int) -> ReportPage:
+    """
+    One page of the period's (campaign_id, btag) rows, most first deposits first.
+    Only the page's rows are fetched; totals and row_count cover the whole period.
+    Rows without registrations or first deposits in the period are left out.
+    """
+    if hour_window.active and period == "hour":
+        stats, totals = _window_hour(telegram_user_id)
+        window_rows = sorted(
+            (
+                (campaign_id, btag, regs, deps, reward_sum)
+                for campaign_id, campaign_stats in stats.items()
+                for btag, (regs, deps, reward_sum) in campaign_stats.items()
+            ),
+            key=lambda row: (-row[3], -row[2], row[0], row[1]),
+        )
+        return ReportPage(window_rows[offset:offset + limit], totals, len(window_rows), offset, limit)
+    sql, params = _periods_query([period], telegram_user_id, page=(limit, offset))
+    with open_user_db(telegram_user_id) as conn:
+        rows = conn.execute(sql, params).fetchall()
+    if not rows:
+        return ReportPage([], (0, 0, 0.0), 0, offset, limit)
+    return ReportPage(
+        [
+            (row["campaign_id"], row["btag"], int(row["p0_reg_count"]), int(row["p0_dep_count"]),
+             float(row["p0_reward_sum"]))
+            for row in rows
+        ],
+        (int(rows[0]["p0_total_reg_count"]), int(rows[0]["p0_total_dep_count"]), float(rows[0]["p0_total_reward_sum"])),
+        int(rows[0]["row_count"]),
+        offset,
+        limit,
+    )
+
+
+@timed(DB_QUERY_SECONDS, "aggregate_by_campaign_and_btag")
+def aggregate_by_campaign_and_btag(telegram_user_id: int, period: str) -> CampaignStats:
     """
     Returns nested mapping: campaign_id -> {btag -> (registrations_count, first_deposits_count, total_reward_sum)}
     period in {"all","hour","day","week","last_week","month"}
     """
+    return aggregate_periods(telegram_user_id, [period])[period].stats
+
+
+def iter_events(telegram_user_id: int, period: str) -> Iterator[sqlite3.Row]:
+    """
+    Streams the partner's raw events in the period in time order without loading them.
+    Each event type is read in index order by its own cursor and the two are merged.
+    """
     period_bounds = _period_bounds(period)
-    params = [telegram_user_id]
     time_filter = ""
+    bounds: List = []
     if period_bounds is not None:
-        time_filter = " AND created_at >= ? AND created_at <= ?"
-        params.append(period_bounds[0])
-        params.append(period_bounds[1])
-
-    # Get registrations grouped by campaign_id and btag
-    sql_regs = f"""
-    SELECT COALESCE(campaign_id, '') AS campaign_id, COALESCE(btag, '') AS btag, COUNT(*) AS reg_count
-    FROM events
-    WHERE telegram_user_id = ? AND event_type = 'registration'{time_filter}
-    GROUP BY campaign_id, btag
-    """
-
-    # Get deposits grouped by campaign_id and btag
-    sql_deps = f"""
-    SELECT COALESCE(campaign_id, '') AS campaign_id, COALESCE(btag, '') AS btag, 
-           COUNT(*) AS dep_count, COALESCE(SUM(reward_snapshot), 0) AS reward_sum
-    FROM events
-    WHERE telegram_user_id = ? AND event_type = 'first_dep'{time_filter}
-    GROUP BY campaign_id, btag
-    """
-
-    results: Dict[str, Dict[str, Tuple[int, int, float]]] = {}
-    with open_db() as conn:
-        # Get all registrations
-        regs_rows = conn.execute(sql_regs, params).fetchall()
-        for row in regs_rows:
-            campaign_id = row["campaign_id"] or ""
-            btag = row["btag"] or ""
-            if campaign_id not in results:
-                results[campaign_id] = {}
-            if btag not in results[campaign_id]:
-                results[campaign_id][btag] = (0, 0, 0.0)
-            regs, deps, reward = results[campaign_id][btag]
-            results[campaign_id][btag] = (int(row["reg_count"]), deps, reward)
-
-        # Get all deposits and merge
-        deps_rows = conn.execute(sql_deps, params).fetchall()
-        for row in deps_rows:
-            campaign_id = row["campaign_id"] or ""
-            btag = row["btag"] or ""
-            if campaign_id not in results:
-                results[campaign_id] = {}
-            if btag not in results[campaign_id]:
-                results[campaign_id][btag] = (0, 0, 0.0)
-            regs, deps, reward = results[campaign_id][btag]
-            results[campaign_id][btag] = (regs, int(row["dep_count"]), float(row["reward_sum"]))
-
-    return results
+        time_filter = " AND created_ts >= ? AND created_ts < ?"
+        bounds = list(_epoch_range(period_bounds))
+    with open_user_db(telegram_user_id) as conn:
+        cursors = [
+            conn.execute(
+                f"""
+                SELECT id, created_at, created_ts, event_type, campaign_id, btag, played_id, reward_snapshot
+                FROM events
+                WHERE telegram_user_id = ? AND event_type = ?{time_filter}
+                ORDER BY created_ts
+                """,
+                [telegram_user_id, event_type] + bounds,
+            )
+            for event_type in ("registration", "first_dep")
+        ]
+        yield from heapq.merge(*cursors, key=lambda row: row["created_ts"])
 
 
 def get_all_user_ids() -> List[int]:
-    with open_db() as conn:
-        rows = conn.execute("SELECT telegram_user_id FROM users").fetchall()
-    return [int(row["telegram_user_id"]) for row in rows]
+    user_ids: List[int] = []
+    for path in shard_paths():
+        with open_db(path) as conn:
+            user_ids.extend(int(row["telegram_user_id"]) for row in conn.execute("SELECT telegram_user_id FROM users"))
+    return sorted(user_ids)
+
+
+def get_report_runs() -> Dict[int, int]:
+    """telegram_user_id -> hour_ts (epoch of the hour's start) of the last hourly report delivered to the user"""
+    runs: Dict[int, int] = {}
+    for path in shard_paths():
+        with open_db(path) as conn:
+            for row in conn.execute("SELECT telegram_user_id, hour_ts FROM report_runs"):
+                runs[int(row["telegram_user_id"])] = int(row["hour_ts"])
+    return runs
+
+
+def set_report_runs(telegram_user_ids: List[int], hour_ts: int) -> None:
+    """Records that the report of the hour starting at hour_ts reached these users"""
+    by_path: Dict[str, List[int]] = {}
+    for telegram_user_id in telegram_user_ids:
+        by_path.setdefault(user_db_path(telegram_user_id), []).append(telegram_user_id)
+    for path, shard_user_ids in by_path.items():
+        with open_db(path) as conn:
+            conn.executemany(
+                """
+                INSERT INTO report_runs (telegram_user_id, hour_ts) VALUES (?, ?)
+                ON CONFLICT (telegram_user_id) DO UPDATE SET hour_ts = MAX(hour_ts, excluded.hour_ts)
+                """,
+                [(telegram_user_id, hour_ts) for telegram_user_id in shard_user_ids],
+            )
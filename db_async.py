@@ -0,0 +1,42 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import db
+from config import DB_ASYNC_WORKERS
+
+# Blocking db calls from the bot run here, so a slow aggregate or a locked database
+# only occupies one worker instead of the event loop. The pool size bounds concurrency.
+_executor = ThreadPoolExecutor(max_workers=DB_ASYNC_WORKERS, thread_name_prefix="db")
+
+
+async def run(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Runs a blocking function on the db worker pool and awaits its result"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def _awaitable(func: Callable[..., Any]) -> Callable[..., Any]:
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
+init_db = _awaitable(db.init_db)
+get_reward = _awaitable(db.get_reward)
+set_reward = _awaitable(db.set_reward)
+get_campaign_reward = _awaitable(db.get_campaign_reward)
+set_campaign_reward = _awaitable(db.set_campaign_reward)
+get_all_campaign_rewards = _awaitable(db.get_all_campaign_rewards)
+aggregate_by_btag = _awaitable(db.aggregate_by_btag)
+aggregate_by_campaign_and_btag = _awaitable(db.aggregate_by_campaign_and_btag)
+aggregate_periods = _awaitable(db.aggregate_periods)
+get_all_user_ids = _awaitable(db.get_all_user_ids)
+get_report_runs = _awaitable(db.get_report_runs)
+set_report_runs = _awaitable(db.set_report_runs)
+
+
+def shutdown() -> None:
+    _executor.shutdown(wait=True)
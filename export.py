@@ -0,0 +1,43 @@
+import csv
+import gzip
+import os
+import tempfile
+
+from config import CAMPAIGN_NAMES
+from db import iter_events
+
+EXPORT_COLUMNS = ["id", "created_at", "event_type", "campaign_id", "campaign_name", "btag", "player_id", "reward"]
+
+# Telegram bots can't send documents larger than this
+MAX_DOCUMENT_BYTES = 50 * 1024 * 1024
+
+
+def export_events_csv(telegram_user_id: int, period: str, compress: bool = False) -> str:
+    """
+    Writes the partner's raw events for the period to a temporary CSV file (optionally gzip)
+    row by row, so memory use doesn't depend on the number of events. Returns the file path;
+    the caller removes the file.
+    """
+    fd, path = tempfile.mkstemp(prefix="export_", suffix=".csv.gz" if compress else ".csv")
+    os.close(fd)
+    try:
+        opener = gzip.open if compress else open
+        with opener(path, "wt", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_COLUMNS)
+            for row in iter_events(telegram_user_id, period):
+                campaign_id = row["campaign_id"] or ""
+                writer.writerow([
+                    row["id"],
+                    row["created_at"],
+                    row["event_type"],
+                    campaign_id,
+                    CAMPAIGN_NAMES.get(campaign_id, ""),
+                    row["btag"] or "",
+                    row["played_id"] or "",
+                    "" if row["reward_snapshot"] is None else row["reward_snapshot"],
+                ])
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
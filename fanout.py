@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_RATE
+from metrics import FANOUT_SECONDS, TELEGRAM_SEND_ERRORS, TELEGRAM_SEND_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float = 0):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # Waiters queue on the lock, so tokens are handed out in FIFO order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RateLimiter:
+    """
+    Telegram send limits: a global messages-per-second bucket plus a minimum interval per chat.
+    pause() stops all sends, e.g. for the retry_after of a flood-control error.
+    """
+
+    def __init__(self, global_rate: float, per_chat_rate: float):
+        self._global = TokenBucket(global_rate)
+        self._chat_interval = 1.0 / per_chat_rate
+        self._chat_next: Dict[int, float] = {}
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id: int) -> None:
+        now = time.monotonic()
+        chat_at = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = chat_at + self._chat_interval
+        if chat_at > now:
+            await asyncio.sleep(chat_at - now)
+        while self._paused_until > time.monotonic():
+            await asyncio.sleep(self._paused_until - time.monotonic())
+        await self._global.acquire()
+
+
+limiter = RateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_RATE)
+
+MAX_MESSAGE_CHARS = 4096
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_CHARS) -> List[str]:
+    """
+    Splits text into messages of at most `limit` characters. Cuts go between blank-line
+    separated blocks, so HTML tags opened in a block (e.g. a blockquote) are closed in the
+    same message; a block that is too long on its own is cut between lines.
+    """
+    if len(text) <= limit:
+        return [text]
+    pieces: List[str] = []
+    for block in text.split("\n\n"):
+        if len(block) <= limit:
+            pieces.append(block)
+            continue
+        for line in block.split("\n"):
+            pieces.extend(line[start:start + limit] for start in range(0, max(len(line), 1), limit))
+    messages: List[str] = []
+    current = ""
+    for piece in pieces:
+        candidate = f"{current}\n\n{piece}" if current else piece
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+        if current.strip():
+            messages.append(current)
+        current = piece
+    if current.strip():
+        messages.append(current)
+    return messages
+
+
+class FanOutStats(NamedTuple):
+    total: int
+    failures: int
+    duration: float
+    p95_latency: float
+
+
+async def send_with_retries(
+    chat_id: int,
+    send: Callable[[], Awaitable[object]],
+    retries: int,
+) -> None:
+    """Sends through the limiter, honouring retry_after and backing off on network/server errors"""
+    attempt = 0
+    while True:
+        await limiter.acquire(chat_id)
+        started = time.perf_counter()
+        try:
+            await send()
+            return
+        except Exception as e:
+            TELEGRAM_SEND_ERRORS.inc(type(e).__name__)
+            if not isinstance(e, (TelegramRetryAfter, TelegramNetworkError, TelegramServerError)):
+                raise
+            error = e
+        finally:
+            TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started)
+        if isinstance(error, TelegramRetryAfter):
+            logger.warning(f"Flood control Telegram, пауза {error.retry_after} с (чат {chat_id})")
+            limiter.pause(error.retry_after)
+        attempt += 1
+        if attempt > retries:
+            raise error
+        if not isinstance(error, TelegramRetryAfter):
+            await asyncio.sleep(min(2 ** attempt, 30))
+
+
+async def fan_out(
+    chat_ids: Iterable[int],
+    build: Callable[[int], Awaitable[str]],
+    send: Callable[[int, str], Awaitable[object]],
+    concurrency: int,
+    retries: int,
+    name: str,
+    on_delivered: Optional[Callable[[int], None]] = None,
+) -> FanOutStats:
+    """
+    Builds and sends a message to every chat with at most `concurrency` chats in flight.
+    on_delivered is called with each chat id once all of its message parts are sent.
+    Logs total duration, p95 per-chat latency and the number of failures.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    failures = 0
+
+    async def deliver(chat_id: int) -> None:
+        nonlocal failures
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                text = await build(chat_id)
+                # Each part is retried on its own, so a retry never resends parts already delivered
+                for part in split_message(text):
+                    await send_with_retries(chat_id, lambda: send(chat_id, part), retries)
+                if on_delivered is not None:
+                    on_delivered(chat_id)
+            except Exception as e:
+                failures += 1
+                logger.error(f"Ошибка при отправке ({name}) пользователю {chat_id}: {e}", exc_info=True)
+            finally:
+                latencies.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    await asyncio.gather(*(deliver(chat_id) for chat_id in chat_ids))
+    duration = time.monotonic() - started
+    FANOUT_SECONDS.observe(duration, name)
+
+    latencies.sort()
+    p95 = latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0
+    stats = FanOutStats(len(latencies), failures, duration, p95)
+    logger.info(
+        f"Рассылка '{name}' завершена: {stats.total} получателей, ошибок {stats.failures}, "
+        f"длительность {stats.duration:.1f} с, p95 на пользователя {stats.p95_latency:.2f} с"
+    )
+    return stats
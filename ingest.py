@@ -0,0 +1,224 @@
+import atexit
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from config import INGEST_MODE, INGEST_QUEUE_SIZE, INGEST_BATCH_SIZE, INGEST_FLUSH_MS, DEDUP_CACHE_SIZE, DB_SHARDS
+from db import insert_event, insert_events, shard_of
+from metrics import INSERT_BATCH_SIZE, INSERT_SECONDS, QUEUE_DEPTH
+from report_cache import report_cache
+
+logger = logging.getLogger(__name__)
+
+# (telegram_user_id, event_type, played_id, btag, campaign_id, created_at)
+Event = Tuple[int, str, Optional[str], Optional[str], Optional[str], datetime]
+
+LOCK_RETRIES = 8
+
+
+class _RecentKeys:
+    """Bounded LRU set of recently accepted (telegram_user_id, event_type, player_id) keys"""
+
+    def __init__(self, size: int):
+        self._size = size
+        self._lock = threading.Lock()
+        self._keys: "OrderedDict[Tuple[int, str, str], None]" = OrderedDict()
+
+    def add(self, key: Tuple[int, str, str]) -> bool:
+        """Returns False if the key was already present"""
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                return False
+            self._keys[key] = None
+            if len(self._keys) > self._size:
+                self._keys.popitem(last=False)
+            return True
+
+    def discard(self, key: Tuple[int, str, str]) -> None:
+        with self._lock:
+            self._keys.pop(key, None)
+
+
+# Answers network retries from memory; the unique index on events is the authority
+# for duplicates this process hasn't seen (e.g. after a restart)
+_recent = _RecentKeys(DEDUP_CACHE_SIZE)
+
+
+def is_duplicate(telegram_user_id: int, event_type: str, played_id: Optional[str]) -> bool:
+    """Checks the in-memory pre-filter and remembers the postback if it's new"""
+    if not played_id:
+        return False
+    return not _recent.add((telegram_user_id, event_type, played_id))
+
+
+def _forget(event: Event) -> None:
+    # The event was not stored, so a retry of it must not be taken for a duplicate
+    if event[2]:
+        _recent.discard((event[0], event[1], event[2]))
+
+
+def _on_written(events: List[Event], inserted: List[bool]) -> None:
+    for telegram_user_id in {event[0] for event, stored in zip(events, inserted) if stored}:
+        report_cache.invalidate_user(telegram_user_id)
+
+
+class BatchWriter:
+    """
+    Write-behind queue for postback events.
+    Request handlers only enqueue events; a writer thread drains the queue
+    and commits them in batches of up to batch_size events or every flush_ms milliseconds.
+    """
+
+    def __init__(self, maxsize: int, batch_size: int, flush_ms: int, name: str = "ingest-writer"):
+        self._queue: "queue.Queue[Optional[Event]]" = queue.Queue(maxsize=maxsize)
+        self._batch_size = max(1, batch_size)
+        self._flush_interval = max(0, flush_ms) / 1000.0
+        self._name = name
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+        self._thread.start()
+
+    def submit(self, event: Event) -> bool:
+        """Returns False if the queue is full and the event was not accepted"""
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except queue.Full:
+            return False
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Flushes everything queued so far and stops the writer thread"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            event = self._queue.get()
+            if event is None:
+                break
+            batch: List[Event] = [event]
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    event = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event)
+            self._flush(batch)
+
+    def _flush(self, batch: List[Event]) -> None:
+        try:
+            for attempt in range(LOCK_RETRIES):
+                try:
+                    with INSERT_SECONDS.time("batch"):
+                        inserted = insert_events(batch)
+                    INSERT_BATCH_SIZE.observe(len(batch))
+                    _on_written(batch, inserted)
+                    return
+                except sqlite3.OperationalError as e:
+                    # The database can stay locked past the busy timeout, e.g. while a migration
+                    # builds an index; keep the batch and retry instead of dropping it
+                    if "locked" not in str(e) or attempt == LOCK_RETRIES - 1:
+                        raise
+                    logger.warning(f"База заблокирована, повтор записи пакета из {len(batch)} событий: {e}")
+                    time.sleep(min(2 ** attempt, 30))
+        except Exception as e:
+            logger.error(f"Ошибка записи пакета из {len(batch)} событий, пробуем по одному: {e}", exc_info=True)
+            for event in batch:
+                try:
+                    _on_written([event], insert_events([event]))
+                except Exception as e:
+                    _forget(event)
+                    logger.error(f"Событие потеряно {event}: {e}")
+
+
+# One writer per shard: shards have separate write locks, so their batches commit in parallel
+writers: List[BatchWriter] = []
+
+
+def start_writer() -> None:
+    if writers or INGEST_MODE != "queue":
+        return
+    for shard in range(DB_SHARDS):
+        writer = BatchWriter(INGEST_QUEUE_SIZE, INGEST_BATCH_SIZE, INGEST_FLUSH_MS, f"ingest-writer-{shard}")
+        writer.start()
+        atexit.register(writer.stop)
+        QUEUE_DEPTH.set_function(writer.qsize, "ingest" if DB_SHARDS == 1 else f"ingest:{shard}")
+        writers.append(writer)
+    logger.info(
+        f"Запущена очередь записи постбеков (очередей {DB_SHARDS}, размер {INGEST_QUEUE_SIZE}, "
+        f"пакет {INGEST_BATCH_SIZE}, интервал {INGEST_FLUSH_MS} мс)"
+    )
+
+
+def stop_writer() -> None:
+    for writer in writers:
+        writer.stop()
+
+
+def enqueue_event(
+    telegram_user_id: int,
+    event_type: str,
+    played_id: Optional[str],
+    btag: Optional[str],
+    campaign_id: Optional[str] = None,
+) -> bool:
+    """Queues an event for the writer thread without blocking; False if it wasn't queued"""
+    if not writers:
+        return False
+    created_at = datetime.utcnow().replace(microsecond=0)
+    if writers[shard_of(telegram_user_id)].submit((telegram_user_id, event_type, played_id, btag, campaign_id, created_at)):
+        return True
+    logger.warning("Очередь постбеков переполнена, запись выполняется синхронно")
+    return False
+
+
+def write_event(
+    telegram_user_id: int,
+    event_type: str,
+    played_id: Optional[str],
+    btag: Optional[str],
+    campaign_id: Optional[str] = None,
+) -> None:
+    """Synchronous insert, used when the writer is not running or the queue is full"""
+    try:
+        with INSERT_SECONDS.time("single"):
+            stored = insert_event(telegram_user_id, event_type, played_id, btag, campaign_id)
+    except Exception:
+        _forget((telegram_user_id, event_type, played_id, btag, campaign_id, datetime.utcnow()))
+        raise
+    if stored:
+        report_cache.invalidate_user(telegram_user_id)
+
+
+def submit_event(
+    telegram_user_id: int,
+    event_type: str,
+    played_id: Optional[str],
+    btag: Optional[str],
+    campaign_id: Optional[str] = None,
+) -> None:
+    """
+    Queues an event for the writer thread.
+    Falls back to a synchronous insert when the writer is not running or the queue is full.
+    """
+    if not enqueue_event(telegram_user_id, event_type, played_id, btag, campaign_id):
+        write_event(telegram_user_id, event_type, played_id, btag, campaign_id)
@@ -0,0 +1,186 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# Seconds; covers sub-millisecond queue submits up to multi-second report fan-outs
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """A value read at scrape time from a callback, e.g. a queue size"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, function: Callable[[], float], *labels: str) -> None:
+        with self._lock:
+            self._functions[labels] = function
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = dict(self._values)
+            functions = list(self._functions.items())
+        for labels, function in functions:
+            values[labels] = function()
+        for labels, value in values.items():
+            yield f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self._bounds = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = ([0] * (len(self._bounds) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = [(labels, list(counts), total[0]) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self._bounds + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}"
+
+
+def timed(histogram: Histogram, *labels: str) -> Callable:
+    """Decorator observing the call duration of a function into `histogram`"""
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *labels)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format"""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+POSTBACKS = Counter("postbacks_total", "Postbacks received, by event type and outcome", ["event_type", "status"])
+POSTBACK_SECONDS = Histogram("postback_handle_seconds", "Postback handler time", ["event_type"])
+BULK_EVENTS = Counter("bulk_events_total", "Events received through /bulk, by outcome", ["status"])
+INSERT_SECONDS = Histogram("db_insert_seconds", "Event insert time (one event or one writer batch)", ["mode"])
+INSERT_BATCH_SIZE = Histogram(
+    "db_insert_batch_size", "Events per writer batch", buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500),
+)
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Time of db aggregate functions", ["function"])
+REPORT_RENDER_SECONDS = Histogram("report_render_seconds", "Report build time including aggregation", ["kind"])
+TELEGRAM_SEND_SECONDS = Histogram("telegram_send_seconds", "bot.send_message latency")
+TELEGRAM_SEND_ERRORS = Counter("telegram_send_errors_total", "Failed bot.send_message calls", ["error"])
+FANOUT_SECONDS = Histogram(
+    "fanout_duration_seconds", "Duration of a whole report fan-out", ["name"],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+SCHEDULER_LAG_SECONDS = Gauge(
+    "scheduler_lag_seconds", "Delay of the hourly report pass behind its schedule (latest slice start, pass finish)",
+    ["stage"],
+)
+REPORT_LAG_SECONDS = Histogram(
+    "report_delivery_lag_seconds", "Delay of a delivered hourly report behind its slot in the hour", ["kind"],
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+QUEUE_DEPTH = Gauge("queue_depth", "Items waiting in in-process queues", ["queue"])
+REPORT_CACHE = Gauge("report_cache", "Report cache counters and size", ["stat"])
+PROCESS_INFO = Gauge(
+    "process_info", "Always 1; tells which process answered, as every process serves only its own metrics",
+    ["role", "pid"],
+)
+STARTUP_SECONDS = Gauge("startup_seconds", "Seconds from process start to each startup stage", ["stage"])
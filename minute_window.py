@@ -0,0 +1,110 @@
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# (campaign_id, btag) -> [registrations_count, first_deposits_count, total_reward_sum]
+_Bucket = Dict[Tuple[str, str], List]
+
+
+def minute_of(moment: datetime) -> int:
+    """Minutes since the epoch of a naive UTC datetime"""
+    return (moment.toordinal() * 1440) + moment.hour * 60 + moment.minute
+
+
+class MinuteWindow:
+    """
+    Per-minute counters of recent events per user, kept in a ring of `minutes + 1` slots:
+    the current (partial) minute plus the `minutes` whole minutes before it.
+    Answers rolling-window stats in O(slots) without touching the database. It only knows
+    events added in this process, so it is switched on by the ingestion path (activate()).
+    """
+
+    def __init__(self, minutes: int):
+        self.slots = minutes + 1
+        self.active = False
+        self._lock = threading.Lock()
+        # user -> ring of (minute, bucket); a slot whose minute has left the window is stale
+        self._rings: Dict[int, List[Optional[Tuple[int, _Bucket]]]] = {}
+
+    def activate(self, events: Iterable[Tuple[int, str, Optional[str], Optional[str], Optional[float], datetime]]) -> None:
+        """Starts from `events` (the recent ones from the database) and begins answering queries"""
+        with self._lock:
+            self._rings.clear()
+            self.active = True
+        for event in events:
+            self.add(*event)
+
+    def add(
+        self,
+        telegram_user_id: int,
+        event_type: str,
+        campaign_id: Optional[str],
+        btag: Optional[str],
+        reward_snapshot: Optional[float],
+        created_at: datetime,
+    ) -> None:
+        if not self.active:
+            return
+        minute = minute_of(created_at)
+        if minute > minute_of(datetime.utcnow()):
+            # A future minute would take the ring slot of a minute still inside the window
+            return
+        key = (campaign_id or "", btag or "")
+        with self._lock:
+            ring = self._rings.get(telegram_user_id)
+            if ring is None:
+                ring = self._rings[telegram_user_id] = [None] * self.slots
+            index = minute % self.slots
+            slot = ring[index]
+            if slot is None or slot[0] != minute:
+                if slot is not None and slot[0] > minute:
+                    return  # older than the window
+                slot = ring[index] = (minute, {})
+            counters = slot[1].get(key)
+            if counters is None:
+                counters = slot[1][key] = [0, 0, 0.0]
+            if event_type == "first_dep":
+                counters[1] += 1
+                counters[2] += reward_snapshot or 0.0
+            else:
+                counters[0] += 1
+
+    def stats(
+        self, telegram_user_id: int, now: datetime,
+    ) -> Tuple[Dict[str, Dict[str, Tuple[int, int, float]]], Tuple[int, int, float]]:
+        """(campaign_id -> {btag -> (regs, deps, reward)}, totals) over the window ending at now"""
+        current = minute_of(now)
+        merged: Dict[Tuple[str, str], List] = {}
+        with self._lock:
+            for slot in self._rings.get(telegram_user_id, ()):
+                if slot is None or not current - self.slots < slot[0] <= current:
+                    continue
+                for key, (regs, deps, reward) in slot[1].items():
+                    counters = merged.get(key)
+                    if counters is None:
+                        merged[key] = [regs, deps, reward]
+                    else:
+                        counters[0] += regs
+                        counters[1] += deps
+                        counters[2] += reward
+        stats: Dict[str, Dict[str, Tuple[int, int, float]]] = {}
+        total_regs, total_deps, total_reward = 0, 0, 0.0
+        for (campaign_id, btag), (regs, deps, reward) in merged.items():
+            stats.setdefault(campaign_id, {})[btag] = (regs, deps, reward)
+            total_regs += regs
+            total_deps += deps
+            total_reward += reward
+        return stats, (total_regs, total_deps, total_reward)
+
+    def users(self, now: datetime) -> List[int]:
+        """Users with events in the window ending at now, in id order; forgets users without any"""
+        current = minute_of(now)
+        with self._lock:
+            idle = [
+                telegram_user_id
+                for telegram_user_id, ring in self._rings.items()
+                if not any(slot is not None and current - self.slots < slot[0] <= current for slot in ring)
+            ]
+            for telegram_user_id in idle:
+                del self._rings[telegram_user_id]
+            return sorted(self._rings)
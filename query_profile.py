@@ -0,0 +1,225 @@
+import logging
+import re
+import sqlite3
+import sys
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from config import DB_SLOW_QUERY_MS, DB_QUERY_TOP_N, DB_QUERY_STATS_WINDOW
+
+logger = logging.getLogger(__name__)
+
+_PLAN_PREFIXES = ("SELECT", "WITH")
+
+
+@lru_cache(maxsize=1024)
+def query_shape(sql: str) -> str:
+    """The statement with whitespace collapsed and literals/placeholder lists folded, for grouping"""
+    shape = re.sub(r"\s+", " ", sql).strip()
+    shape = re.sub(r"\?(\s*,\s*\?)+", "?, ...", shape)
+    shape = re.sub(r"'[^']*'", "'?'", shape)
+    return re.sub(r"\b\d+(\.\d+)?\b", "N", shape)
+
+
+def _caller() -> str:
+    frame = sys._getframe(1)
+    # Skip this module and comprehension frames, so the statement is charged to the function
+    while frame is not None and (
+        frame.f_code.co_filename == __file__ or frame.f_code.co_name in ("<listcomp>", "<genexpr>", "<dictcomp>")
+    ):
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}"
+
+
+class ShapeStats(NamedTuple):
+    shape: str
+    count: int
+    total: float
+    max: float
+    rows: int
+    callers: Set[str]
+
+
+class QueryStats:
+    """
+    Per-shape totals over a rolling window: the current window plus the previous one,
+    so a dump always covers between one and two windows of recent statements.
+    """
+
+    def __init__(self, window: float):
+        self._window = window
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._current: Dict[str, List] = {}
+        self._previous: Dict[str, List] = {}
+
+    def record(self, shape: str, caller: str, elapsed: float, rows: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._started >= self._window:
+                self._previous = self._current if now - self._started < 2 * self._window else {}
+                self._current = {}
+                self._started = now
+            entry = self._current.get(shape)
+            if entry is None:
+                entry = self._current[shape] = [0, 0.0, 0.0, 0, set()]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+            entry[3] += rows
+            entry[4].add(caller)
+
+    def top(self, n: int = DB_QUERY_TOP_N) -> List[ShapeStats]:
+        """The n shapes with the largest total time"""
+        merged: Dict[str, ShapeStats] = {}
+        with self._lock:
+            for window in (self._previous, self._current):
+                for shape, (count, total, longest, rows, callers) in window.items():
+                    known = merged.get(shape)
+                    if known is not None:
+                        count += known.count
+                        total += known.total
+                        longest = max(longest, known.max)
+                        rows += known.rows
+                        callers = callers | known.callers
+                    merged[shape] = ShapeStats(shape, count, total, longest, rows, set(callers))
+        return sorted(merged.values(), key=lambda item: item.total, reverse=True)[:n]
+
+
+query_stats = QueryStats(DB_QUERY_STATS_WINDOW)
+
+
+def _explain(conn: sqlite3.Connection, sql: str, params) -> str:
+    if not sql.lstrip().upper().startswith(_PLAN_PREFIXES):
+        return ""
+    try:
+        # The base method, so the plan lookup itself is not profiled
+        rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except sqlite3.Error as e:
+        return f"(план недоступен: {e})"
+    return "\n".join(f"  {row[3]}" for row in rows)
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    Accumulates the time spent in execute and in fetching rows; the statement is recorded
+    once its rows are exhausted, fetched with fetchall() or the cursor is dropped.
+    """
+
+    _sql: Optional[str] = None
+
+    def _start(self, sql: str, params) -> None:
+        self._finish()
+        self._sql = sql
+        self._params = params
+        self._caller = _caller()
+        self._elapsed = 0.0
+        self._rows = 0
+
+    def _finish(self, rows: Optional[int] = None) -> None:
+        sql = self._sql
+        if sql is None:
+            return
+        self._sql = None
+        rows = self._rows if rows is None else rows
+        query_stats.record(query_shape(sql), self._caller, self._elapsed, rows)
+        if self._elapsed * 1000 >= DB_SLOW_QUERY_MS:
+            plan = _explain(self.connection, sql, self._params) if self._params is not None else ""
+            logger.warning(
+                f"Медленный запрос {self._elapsed * 1000:.0f} мс, строк {rows}, вызов {self._caller}: "
+                f"{query_shape(sql)}" + (f"\nПлан запроса:\n{plan}" if plan else "")
+            )
+
+    def execute(self, sql: str, parameters=()):
+        self._start(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._elapsed += time.perf_counter() - started
+
+    def executemany(self, sql: str, seq_of_parameters):
+        self._start(sql, None)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._elapsed += time.perf_counter() - started
+            self._finish(max(self.rowcount, 0))
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._elapsed += time.perf_counter() - started
+            self._finish()
+            raise
+        self._elapsed += time.perf_counter() - started
+        self._rows += 1
+        return row
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._elapsed += time.perf_counter() - started
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size: int = -1):
+        started = time.perf_counter()
+        rows = super().fetchmany(size) if size >= 0 else super().fetchmany()
+        self._elapsed += time.perf_counter() - started
+        self._rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._elapsed += time.perf_counter() - started
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def close(self) -> None:
+        self._finish()
+        super().close()
+
+    def __del__(self) -> None:
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """Connection whose cursors, including the ones behind conn.execute(), are profiled"""
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def format_top(n: int = DB_QUERY_TOP_N, shape_chars: int = 600) -> List[str]:
+    """One plain-text entry per expensive query shape, most expensive first"""
+    entries = []
+    for index, item in enumerate(query_stats.top(n), start=1):
+        entries.append(
+            f"{index}. всего {item.total:.2f} с, {item.count} раз, среднее {item.total / item.count * 1000:.1f} мс, "
+            f"макс {item.max * 1000:.0f} мс, строк {item.rows}\n"
+            f"вызов: {', '.join(sorted(item.callers))}\n"
+            f"{item.shape[:shape_chars]}{'…' if len(item.shape) > shape_chars else ''}"
+        )
+    return entries
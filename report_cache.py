@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, NamedTuple, Set, Tuple
+
+from config import REPORT_CACHE_MAX_BYTES, REPORT_CACHE_BUCKET_SECONDS
+from db import ReportPage
+from metrics import REPORT_CACHE
+
+# (user_id, period, page, page size, time bucket)
+CacheKey = Tuple[int, str, int, int, int]
+
+
+class CachedReport(NamedTuple):
+    page: ReportPage
+    text: str
+    size: int
+
+
+def _estimate_size(page: ReportPage, text: str) -> int:
+    # Rendered text plus a rough per-row cost of the page's tuples
+    return len(text.encode("utf-8")) + 200 * len(page.rows) + 300
+
+
+class ReportCache:
+    """
+    LRU cache of report pages and rendered text keyed by (user_id, period, page, page size, time bucket).
+    The time bucket bounds how stale a rolling period can get; new events for a user
+    invalidate all of the user's entries. Memory use is capped at max_bytes (estimated).
+    Invalidation only sees events written by this process, so a process that doesn't ingest
+    postbacks itself turns the cache off (enabled = False) and builds every report.
+    """
+
+    def __init__(self, max_bytes: int, bucket_seconds: int):
+        self.max_bytes = max_bytes
+        self.bucket_seconds = max(1, bucket_seconds)
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[CacheKey, CachedReport]" = OrderedDict()
+        self._user_keys: Dict[int, Set[CacheKey]] = {}
+        self._generations: Dict[int, int] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _key(self, user_id: int, period: str, page: int, page_size: int) -> CacheKey:
+        return user_id, period, page, page_size, int(time.time() // self.bucket_seconds)
+
+    def get_or_build(
+        self,
+        user_id: int,
+        period: str,
+        page: int,
+        page_size: int,
+        build: Callable[[int, str, int, int], Tuple[ReportPage, str]],
+    ) -> Tuple[ReportPage, str]:
+        if not self.enabled:
+            return build(user_id, period, page, page_size)
+        key = self._key(user_id, period, page, page_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.page, entry.text
+            self.misses += 1
+            generation = self._generations.get(user_id, 0)
+        report_page, text = build(user_id, period, page, page_size)
+        self._put(key, generation, CachedReport(report_page, text, _estimate_size(report_page, text)))
+        return report_page, text
+
+    def _put(self, key: CacheKey, generation: int, entry: CachedReport) -> None:
+        user_id = key[0]
+        with self._lock:
+            # An event landed while the report was being built: don't cache the stale result
+            if self._generations.get(user_id, 0) != generation or entry.size > self.max_bytes:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.size
+            self._entries[key] = entry
+            self._user_keys.setdefault(user_id, set()).add(key)
+            self._bytes += entry.size
+            while self._bytes > self.max_bytes:
+                old_key, old_entry = self._entries.popitem(last=False)
+                self._forget(old_key, old_entry)
+                self.evictions += 1
+
+    def _forget(self, key: CacheKey, entry: CachedReport) -> None:
+        self._bytes -= entry.size
+        keys = self._user_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[key[0]]
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            for key in self._user_keys.pop(user_id, ()):
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._bytes -= entry.size
+                    self.invalidations += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+report_cache = ReportCache(REPORT_CACHE_MAX_BYTES, REPORT_CACHE_BUCKET_SECONDS)
+
+for _stat in ("hits", "misses", "evictions", "invalidations", "entries", "bytes"):
+    REPORT_CACHE.set_function(lambda stat=_stat: report_cache.stats()[stat], _stat)
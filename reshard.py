@@ -0,0 +1,135 @@
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+from typing import Dict, List
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Tables copied to the shard of their telegram_user_id; meta only holds migration progress
+SHARDED_TABLES = ("users", "campaign_rewards", "report_runs", "event_rollups_hourly", "events")
+ROLLUP_TRIGGER = "trg_events_rollup_hourly"
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")]
+
+
+def _copy_source(conn: sqlite3.Connection, shard: int, shards: int) -> Dict[str, int]:
+    """Copies the attached `source` database's rows of one target shard in a single transaction"""
+    copied: Dict[str, int] = {}
+    # Same rule as db.shard_of(): SQLite's % keeps the sign of negative ids, Python's doesn't
+    condition = "((telegram_user_id % :shards) + :shards) % :shards = :shard"
+    params = {"shards": shards, "shard": shard}
+    conn.execute("BEGIN IMMEDIATE")
+    # Rollups are copied as they are, so the trigger must not count the copied events again
+    trigger_sql = conn.execute(
+        "SELECT sql FROM main.sqlite_master WHERE type = 'trigger' AND name = ?", (ROLLUP_TRIGGER,),
+    ).fetchone()[0]
+    conn.execute(f"DROP TRIGGER main.{ROLLUP_TRIGGER}")
+    for table in SHARDED_TABLES:
+        columns = _columns(conn, table)
+        order = ""
+        if table == "events":
+            # Event ids repeat across source shards, so events get new ids in their original order
+            columns.remove("id")
+            order = " ORDER BY id"
+        column_list = ", ".join(columns)
+        cur = conn.execute(
+            f"""
+            INSERT INTO main.{table} ({column_list})
+            SELECT {column_list} FROM source.{table} WHERE {condition}{order}
+            """,
+            params,
+        )
+        copied[table] = cur.rowcount
+    conn.execute(trigger_sql)
+    conn.commit()
+    return copied
+
+
+def reshard(source: str, source_shards: int, output: str, shards: int) -> Dict[str, int]:
+    """
+    Splits the database files of `source_shards` shards at `source` into `shards` new files
+    at `output` (the same naming as DB_SHARDS uses). The service must be stopped while it runs:
+    postbacks written to the old files in the meantime would not be copied.
+    """
+    source_paths = [db.sharded_path(source, shard, source_shards) for shard in range(source_shards)]
+    target_paths = [db.sharded_path(output, shard, shards) for shard in range(shards)]
+    missing = [path for path in source_paths if not os.path.exists(path)]
+    if missing:
+        raise ValueError(f"source database not found: {', '.join(missing)}")
+    existing = [path for path in target_paths if os.path.exists(path)]
+    if existing:
+        raise ValueError(f"target database already exists: {', '.join(existing)}")
+
+    started = time.monotonic()
+    # Brings the sources up to the current schema and data (rollups are copied as they are)
+    # and creates the targets with it
+    db.init_db(source_paths)
+    db.run_backfills(source_paths)
+    db.init_db(target_paths)
+    db.close_db()
+
+    totals = {table: 0 for table in SHARDED_TABLES}
+    for shard, target in enumerate(target_paths):
+        conn = db.connect(target)
+        try:
+            for source_path in source_paths:
+                conn.execute("ATTACH DATABASE ? AS source", (source_path,))
+                copied = _copy_source(conn, shard, shards)
+                conn.execute("DETACH DATABASE source")
+                for table, count in copied.items():
+                    totals[table] += count
+            conn.execute("ANALYZE")
+        finally:
+            conn.close()
+        logger.info(f"Шард {shard + 1}/{shards} готов: {target}")
+
+    expected = {table: 0 for table in SHARDED_TABLES}
+    for source_path in source_paths:
+        conn = db.connect(source_path)
+        try:
+            for table in SHARDED_TABLES:
+                expected[table] += conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        finally:
+            conn.close()
+    if totals != expected:
+        raise RuntimeError(f"row counts differ after resharding: copied {totals}, source {expected}")
+    logger.info(
+        f"Перераспределение на {shards} шардов завершено за {time.monotonic() - started:.1f} с: "
+        + ", ".join(f"{table} {count}" for table, count in totals.items())
+    )
+    return totals
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Splits the database into DB_SHARDS files by telegram_user_id; run it with the service stopped",
+    )
+    parser.add_argument("shards", type=int, help="number of target shards")
+    parser.add_argument("--source", default=db.DB_PATH, help="path of the current database (default: %(default)s)")
+    parser.add_argument("--source-shards", type=int, default=1, help="shards of the current database (default: 1)")
+    parser.add_argument("--output", default=db.DB_PATH, help="base path of the new shards (default: %(default)s)")
+    args = parser.parse_args()
+    if args.shards < 1 or args.source_shards < 1:
+        parser.error("shard counts must be positive")
+    try:
+        reshard(args.source, args.source_shards, args.output, args.shards)
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    logger.info(f"Запускайте сервис с DB_SHARDS={args.shards}; старые файлы базы можно удалить после проверки")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    main()
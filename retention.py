@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Tuple
+
+import db
+from config import RETENTION_DAYS, ARCHIVE_DB_PATH, RETENTION_CHUNK_SIZE, RETENTION_PAUSE_MS
+
+logger = logging.getLogger(__name__)
+
+DAY_SECONDS = 86400
+ARCHIVE_COLUMNS = "id, telegram_user_id, event_type, played_id, btag, campaign_id, reward_snapshot, created_at, created_ts"
+
+
+def _cutoff(days: int) -> datetime:
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - timedelta(days=days)
+
+
+def _pause() -> None:
+    # Let postback writes in between chunks
+    time.sleep(RETENTION_PAUSE_MS / 1000.0)
+
+
+def compact_rollups(conn, cutoff_ts: int) -> int:
+    """
+    Folds hourly rollups older than the cutoff into one row per day (stored at the day's 00:00 hour).
+    Every period that reaches that far back starts and ends at midnight, so totals stay exact.
+    """
+    folded = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            """
+            SELECT telegram_user_id, hour_ts, campaign_id, btag, reg_count, dep_count, reward_sum
+            FROM event_rollups_hourly
+            WHERE hour_ts < ? AND hour_ts % 86400 != 0
+            LIMIT ?
+            """,
+            (cutoff_ts, RETENTION_CHUNK_SIZE),
+        ).fetchall()
+        conn.executemany(
+            """
+            INSERT INTO event_rollups_hourly
+                (telegram_user_id, hour_ts, campaign_id, btag, reg_count, dep_count, reward_sum)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (telegram_user_id, hour_ts, campaign_id, btag) DO UPDATE SET
+                reg_count = reg_count + excluded.reg_count,
+                dep_count = dep_count + excluded.dep_count,
+                reward_sum = reward_sum + excluded.reward_sum
+            """,
+            [
+                (row[0], row[1] - row[1] % DAY_SECONDS, row[2], row[3], row[4], row[5], row[6])
+                for row in rows
+            ],
+        )
+        conn.executemany(
+            """
+            DELETE FROM event_rollups_hourly
+            WHERE telegram_user_id = ? AND hour_ts = ? AND campaign_id = ? AND btag = ?
+            """,
+            [(row[0], row[1], row[2], row[3]) for row in rows],
+        )
+        conn.commit()
+        folded += len(rows)
+        if len(rows) < RETENTION_CHUNK_SIZE:
+            return folded
+        _pause()
+
+
+def archive_events(conn, cutoff_ts: int) -> int:
+    """
+    Moves raw events older than the cutoff into the attached archive database.
+    Copies are idempotent, so a chunk interrupted between the two files is simply redone.
+    """
+    moved = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        ids = [
+            row[0]
+            for row in conn.execute(
+                "SELECT id FROM main.events WHERE created_ts < ? ORDER BY created_ts LIMIT ?",
+                (cutoff_ts, RETENTION_CHUNK_SIZE),
+            )
+        ]
+        if ids:
+            placeholders = ",".join("?" * len(ids))
+            conn.execute(
+                f"""
+                INSERT OR IGNORE INTO archive.events ({ARCHIVE_COLUMNS})
+                SELECT {ARCHIVE_COLUMNS} FROM main.events WHERE id IN ({placeholders})
+                """,
+                ids,
+            )
+            conn.execute(f"DELETE FROM main.events WHERE id IN ({placeholders})", ids)
+        conn.commit()
+        moved += len(ids)
+        if len(ids) < RETENTION_CHUNK_SIZE:
+            return moved
+        _pause()
+
+
+def reclaim_space(conn) -> None:
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        logger.info("auto_vacuum не INCREMENTAL, место не освобождается (python retention.py --enable-incremental-vacuum)")
+        return
+    while True:
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free_pages == 0:
+            return
+        # sqlite3 resets a statement without result columns after its first step, and
+        # incremental_vacuum frees one page per step, so free the chunk page by page
+        conn.execute("BEGIN IMMEDIATE")
+        for _ in range(min(free_pages, RETENTION_CHUNK_SIZE)):
+            conn.execute("PRAGMA incremental_vacuum(1)")
+        conn.commit()
+        _pause()
+
+
+def run_retention(days: int = RETENTION_DAYS, path: str = "", archive_path: str = "") -> Dict[str, int]:
+    """
+    Keeps raw events for `days` full days: older hourly rollups are folded into daily ones,
+    older raw events are moved to ARCHIVE_DB_PATH and freed pages are vacuumed incrementally.
+    Runs in small transactions so postback writes are never blocked for long.
+    Every shard is processed in turn with its own archive file, since event ids repeat across shards;
+    `path` (with `archive_path`) limits the run to one database file.
+    """
+    if days < 1:
+        raise ValueError("retention must keep at least one day of raw events")
+    cutoff = _cutoff(days)
+    cutoff_ts = int(db._epoch(cutoff))
+    started = time.monotonic()
+    if path:
+        targets = [(path, archive_path or ARCHIVE_DB_PATH)]
+    else:
+        targets = [
+            (shard_path, db.sharded_path(ARCHIVE_DB_PATH, shard))
+            for shard, shard_path in enumerate(db.shard_paths())
+        ]
+    result = {"rollups_folded": 0, "events_archived": 0}
+    for target_path, target_archive in targets:
+        folded, moved = _retain(target_path, target_archive, cutoff_ts)
+        result["rollups_folded"] += folded
+        result["events_archived"] += moved
+    logger.info(
+        f"Очистка старых данных (старше {cutoff:%Y-%m-%d}): свернуто строк сводки {result['rollups_folded']}, "
+        f"перенесено в архив событий {result['events_archived']}, за {time.monotonic() - started:.1f} с"
+    )
+    return result
+
+
+def _retain(path: str, archive_path: str, cutoff_ts: int) -> Tuple[int, int]:
+    conn = db.connect(path)
+    try:
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS archive.events (
+                id INTEGER PRIMARY KEY,
+                telegram_user_id INTEGER NOT NULL,
+                event_type TEXT NOT NULL,
+                played_id TEXT,
+                btag TEXT,
+                campaign_id TEXT,
+                reward_snapshot REAL,
+                created_at TIMESTAMP NOT NULL,
+                created_ts INTEGER
+            )
+            """
+        )
+        # Archives started before created_ts existed
+        if "created_ts" not in [row[1] for row in conn.execute("PRAGMA archive.table_info(events)")]:
+            conn.execute("ALTER TABLE archive.events ADD COLUMN created_ts INTEGER")
+        conn.commit()
+        folded = compact_rollups(conn, cutoff_ts)
+        moved = archive_events(conn, cutoff_ts)
+        conn.execute("DETACH DATABASE archive")
+        reclaim_space(conn)
+    finally:
+        conn.close()
+    return folded, moved
+
+
+def enable_incremental_vacuum(path: str = "") -> None:
+    """One-off switch of existing databases to auto_vacuum=INCREMENTAL; rewrites the whole files"""
+    for target_path in [path] if path else db.shard_paths():
+        conn = db.connect(target_path)
+        try:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        finally:
+            conn.close()
+
+
+async def retention_scheduler():
+    logger.info(f"Запущена очистка старых данных (хранение {RETENTION_DAYS} дн.)")
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            # Its own thread, so the long job doesn't occupy a db worker of the bot
+            await loop.run_in_executor(None, run_retention)
+        except Exception as e:
+            logger.error(f"Ошибка при очистке старых данных: {e}", exc_info=True)
+        await asyncio.sleep(DAY_SECONDS)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    db.init_db()
+    db.run_backfills()
+    if "--enable-incremental-vacuum" in sys.argv:
+        enable_incremental_vacuum()
+    if RETENTION_DAYS > 0:
+        run_retention()
+    else:
+        logger.info("RETENTION_DAYS не задан, очистка старых данных выключена")
@@ -1,9 +1,23 @@
+import startup  # first, so the startup report counts from here
+import argparse
+import os
+import socket
 import threading
 import asyncio
 import logging
+from typing import Optional, Set
 
-from server import run_flask
-from bot import run_bot
+from config import (
+    FLASK_HOST, FLASK_PORT, INGEST_SERVER, INGEST_WORKERS, METRICS_PORT, RUN_ROLE, WORKER_SHUTDOWN_TIMEOUT,
+)
+import db_async
+from db import close_db, enable_hour_window, init_db, start_backfills
+from ingest import stop_writer
+from metrics import PROCESS_INFO
+from report_cache import report_cache
+
+# aiogram, aiohttp and Flask take most of the import time, so each role imports only
+# the frameworks it runs (inside the functions below)
 
 # Настройка логирования для основного модуля
 logging.basicConfig(
@@ -13,31 +27,148 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+ROLES = ("ingest", "bot", "scheduler")
 
-def main():
-    logger.info("=" * 60)
-    logger.info("Запуск приложения KazikPartnerStats")
-    logger.info("=" * 60)
-    
-    try:
+
+def parse_roles(value: str) -> Set[str]:
+    """"all" or a comma-separated subset of ROLES"""
+    if value == "all":
+        return set(ROLES)
+    roles = {role.strip() for role in value.split(",") if role.strip()}
+    unknown = roles - set(ROLES)
+    if not roles or unknown:
+        raise ValueError(
+            f"unknown role {', '.join(sorted(unknown)) or repr(value)}, expected all, supervisor or {', '.join(ROLES)}"
+        )
+    return roles
+
+
+def _check_db(hour_window: bool = False) -> None:
+    startup.mark("imports")
+    init_db()
+    if hour_window:
+        # Reports are served next to ingestion, so the last hour can be answered from memory
+        enable_hour_window()
+    startup.mark("db")
+
+
+def run_roles(roles: Set[str], listen_fd: Optional[int] = None, metrics_port: Optional[int] = None) -> None:
+    polling, scheduler = "bot" in roles, "scheduler" in roles
+    if roles == {"ingest"}:
+        if listen_fd is not None or INGEST_SERVER == "aiohttp":
+            from aioserver import run_standalone
+
+            _check_db()
+            if listen_fd is None:
+                run_standalone()
+            else:
+                # The supervisor runs the backfills, not each of its workers
+                run_standalone(socket.socket(fileno=listen_fd), backfills=False, metrics_port=metrics_port)
+        else:
+            from server import run_flask
+
+            _check_db()
+            run_flask()
+        return
+
+    from bot import run_bot
+
+    if "ingest" not in roles:
+        _check_db()
+        # Postbacks are written by other processes: the report cache would never be invalidated
+        # and the in-memory hour window would miss their events, so reports read the database
+        logger.info(f"Запуск без приема постбеков: {', '.join(sorted(roles))}")
+        report_cache.enabled = False
+
+        async def run_bot_with_metrics():
+            # No postback server here to serve /metrics, so the bot's metrics get their own port
+            runner = None
+            if METRICS_PORT:
+                from aioserver import start_metrics_server
+
+                runner = await start_metrics_server(FLASK_HOST, METRICS_PORT)
+            try:
+                await run_bot(polling, scheduler)
+            finally:
+                if runner is not None:
+                    await runner.cleanup()
+
+        asyncio.run(run_bot_with_metrics())
+    elif INGEST_SERVER == "aiohttp":
+        from aioserver import start_server
+
+        async def run_bot_with_aiohttp():
+            runner = await start_server()
+            try:
+                await run_bot(polling, scheduler)
+            finally:
+                await runner.cleanup()
+
+        _check_db(hour_window=True)
+        logger.info("Запуск Telegram бота и сервера постбеков (aiohttp) в одном цикле событий...")
+        asyncio.run(run_bot_with_aiohttp())
+    else:
+        from server import run_flask
+
+        _check_db(hour_window=True)
         logger.info("Запуск Flask сервера в отдельном потоке...")
         flask_thread = threading.Thread(target=run_flask, daemon=True)
         flask_thread.start()
         logger.info("✓ Flask сервер запущен")
-        
+
         logger.info("Запуск Telegram бота...")
-        asyncio.run(run_bot())
+        asyncio.run(run_bot(polling, scheduler))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KazikPartnerStats")
+    parser.add_argument(
+        "role", nargs="?", default=RUN_ROLE,
+        help=f"all, supervisor or a comma-separated subset of {', '.join(ROLES)} (default: RUN_ROLE={RUN_ROLE})",
+    )
+    # Set by the supervisor for its postback workers
+    parser.add_argument("--listen-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--metrics-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    roles: Set[str] = set()
+    if args.role != "supervisor":
+        try:
+            roles = parse_roles(args.role)
+        except ValueError as e:
+            parser.error(str(e))
+
+    PROCESS_INFO.set(1, args.role, str(os.getpid()))
+    logger.info("=" * 60)
+    logger.info(f"Запуск приложения KazikPartnerStats ({args.role}, pid {os.getpid()})")
+    logger.info("=" * 60)
+
+    try:
+        if args.role == "supervisor":
+            from supervisor import Supervisor
+
+            startup.mark("imports")
+            # Migrate once here, so the workers and the bot only find the schema up to date;
+            # data backfills run in the background while the workers accept postbacks
+            init_db()
+            start_backfills()
+            startup.mark("db")
+            startup.report()
+            Supervisor(
+                INGEST_WORKERS or os.cpu_count() or 1, FLASK_HOST, FLASK_PORT, WORKER_SHUTDOWN_TIMEOUT, METRICS_PORT,
+            ).run()
+        else:
+            run_roles(roles, args.listen_fd, args.metrics_port)
     except KeyboardInterrupt:
         logger.info("Получен сигнал остановки приложения")
     except Exception as e:
         logger.error(f"Критическая ошибка при запуске приложения: {e}", exc_info=True)
         raise
     finally:
+        stop_writer()
+        db_async.shutdown()
+        close_db()
         logger.info("Приложение остановлено")
 
 
 if __name__ == "__main__":
     main()
-
-
-
@@ -1,29 +1,65 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 
 from config import FLASK_HOST, FLASK_PORT
-from db import init_db, insert_event
+from bulk import BulkImport, detect_format
+from db import init_db, start_backfills
+from ingest import is_duplicate, start_writer, submit_event
+from metrics import BULK_EVENTS, CONTENT_TYPE, POSTBACKS, POSTBACK_SECONDS, render
+import startup
 
 app = Flask(__name__)
 
 
-@app.route('/<int:telegram_user_id>/registration', methods=['GET', 'POST'])
-def registration(telegram_user_id: int):
-    player_id = '-'
+def _accept(telegram_user_id: int, event_type: str):
+    player_id = request.args.get('player_id')
     btag = request.args.get('btag')
     campaign_id = request.args.get('campaign_id')
-    insert_event(telegram_user_id, 'registration', player_id, btag, campaign_id)
-    return jsonify({"status": "ok"})
+    with POSTBACK_SECONDS.time(event_type):
+        if is_duplicate(telegram_user_id, event_type, player_id):
+            POSTBACKS.inc(event_type, "duplicate")
+            return jsonify({"status": "duplicate"})
+        try:
+            submit_event(telegram_user_id, event_type, player_id, btag, campaign_id)
+        except Exception:
+            POSTBACKS.inc(event_type, "error")
+            raise
+        POSTBACKS.inc(event_type, "ok")
+        return jsonify({"status": "ok"})
+
+
+@app.route('/<int:telegram_user_id>/registration', methods=['GET', 'POST'])
+def registration(telegram_user_id: int):
+    return _accept(telegram_user_id, 'registration')
 
 
 @app.route('/<int:telegram_user_id>/firstdep', methods=['GET', 'POST'])
 def first_dep(telegram_user_id: int):
-    player_id = '-'
-    btag = request.args.get('btag')
-    campaign_id = request.args.get('campaign_id')
-    insert_event(telegram_user_id, 'first_dep', player_id, btag, campaign_id)
-    return jsonify({"status": "ok"})
+    return _accept(telegram_user_id, 'first_dep')
+
+
+@app.route('/bulk', methods=['POST'])
+def bulk():
+    batch = BulkImport(detect_format(request.content_type, request.args.get('format')))
+    for line in request.stream:
+        batch.feed(line)
+        if batch.ready():
+            batch.flush()
+    batch.flush()
+    summary = batch.summary()
+    for status in ("accepted", "duplicate", "rejected"):
+        BULK_EVENTS.inc(status, amount=summary[status])
+    return jsonify(summary)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render(), content_type=CONTENT_TYPE)
 
 
 def run_flask():
     init_db()
+    start_writer()
+    startup.mark("listening")
+    startup.report()
+    start_backfills()
     app.run(host=FLASK_HOST, port=FLASK_PORT, threaded=True)
@@ -0,0 +1,35 @@
+import logging
+import time
+from typing import List, Tuple
+
+from metrics import STARTUP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Taken when the module is first imported; run.py imports it before anything heavy
+_started = time.monotonic()
+_stages: List[Tuple[str, float]] = []
+
+STAGE_NAMES = {
+    "imports": "импорт модулей",
+    "db": "проверка базы",
+    "listening": "запуск сервера постбеков",
+    "first_poll": "первый запрос getUpdates",
+}
+
+
+def mark(stage: str) -> None:
+    """Records the seconds since process start at which a startup stage was reached"""
+    elapsed = time.monotonic() - _started
+    _stages.append((stage, elapsed))
+    STARTUP_SECONDS.set(elapsed, stage)
+
+
+def report() -> None:
+    """Logs the startup stages reached so far, each with its own duration and the running total"""
+    parts = []
+    previous = 0.0
+    for stage, elapsed in _stages:
+        parts.append(f"{STAGE_NAMES.get(stage, stage)} {elapsed - previous:.2f} с")
+        previous = elapsed
+    logger.info(f"Время запуска {previous:.2f} с: {', '.join(parts)}")
@@ -0,0 +1,120 @@
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RUN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run.py")
+# A process that dies sooner than this after its start is restarted with a growing delay
+MIN_UPTIME = 10.0
+MAX_RESTART_DELAY = 30.0
+
+
+class _Child:
+    """One supervised process: its command line and restart bookkeeping"""
+
+    def __init__(self, name: str, args: List[str], pass_fds: Tuple[int, ...] = ()):
+        self.name = name
+        self.args = args
+        self.pass_fds = pass_fds
+        self.process: Optional[subprocess.Popen] = None
+        self.started_at = 0.0
+        self.restart_at = 0.0
+        self.restart_delay = 1.0
+
+    def start(self) -> None:
+        self.process = subprocess.Popen([sys.executable, RUN_SCRIPT] + self.args, pass_fds=self.pass_fds)
+        self.started_at = time.monotonic()
+        logger.info(f"Запущен процесс {self.name} (pid {self.process.pid})")
+
+    def check(self) -> None:
+        """Restarts the process if it has exited, backing off while it keeps crashing on start"""
+        now = time.monotonic()
+        if self.process is None:
+            if now >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll()
+        if code is None:
+            return
+        uptime = now - self.started_at
+        self.restart_delay = 1.0 if uptime >= MIN_UPTIME else min(self.restart_delay * 2, MAX_RESTART_DELAY)
+        self.restart_at = now + self.restart_delay
+        self.process = None
+        logger.error(
+            f"Процесс {self.name} завершился с кодом {code} через {uptime:.0f} с, "
+            f"перезапуск через {self.restart_delay:.0f} с"
+        )
+
+    def terminate(self) -> None:
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+    def wait(self, deadline: float) -> None:
+        if self.process is None:
+            return
+        try:
+            self.process.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Процесс {self.name} не остановился вовремя, завершаем принудительно")
+            self.process.kill()
+            self.process.wait()
+
+
+class Supervisor:
+    """
+    Runs `workers` postback server processes that accept connections from one listening socket
+    opened here, plus one process with the bot and the report scheduler. A process that dies is
+    restarted; SIGTERM/SIGINT stop all of them, each worker flushing its queued events first.
+    """
+
+    def __init__(self, workers: int, host: str, port: int, shutdown_timeout: float, metrics_port: int = 0):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.shutdown_timeout = shutdown_timeout
+        # The bot process serves its metrics on metrics_port, worker i on metrics_port + 1 + i; 0 disables
+        self.metrics_port = metrics_port
+        self._stopping = False
+
+    def _stop(self, signum, frame) -> None:
+        logger.info(f"Получен сигнал {signal.Signals(signum).name}, остановка процессов")
+        self._stopping = True
+
+    def run(self) -> None:
+        listener = socket.create_server((self.host, self.port), backlog=1024)
+        listener.set_inheritable(True)
+        fd = listener.fileno()
+        children = []
+        for index in range(self.workers):
+            args = ["ingest", "--listen-fd", str(fd)]
+            if self.metrics_port:
+                args += ["--metrics-port", str(self.metrics_port + 1 + index)]
+            children.append(_Child(f"ingest-{index}", args, pass_fds=(fd,)))
+        children.append(_Child("bot", ["bot,scheduler"]))
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        logger.info(f"Супервизор: {self.workers} процессов постбеков на {self.host}:{self.port} и процесс бота")
+        if self.metrics_port:
+            logger.info(
+                f"Метрики: процесс бота на порту {self.metrics_port}, "
+                f"процессы постбеков на {self.metrics_port + 1}–{self.metrics_port + self.workers}"
+            )
+        try:
+            while not self._stopping:
+                for child in children:
+                    child.check()
+                time.sleep(0.5)
+        finally:
+            for child in children:
+                child.terminate()
+            deadline = time.monotonic() + self.shutdown_timeout
+            for child in children:
+                child.wait(deadline)
+            listener.close()
+            logger.info("Все процессы остановлены")
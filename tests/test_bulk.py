@@ -0,0 +1,20 @@
+import json
+
+import pytest
+
+from bulk import BulkImport
+
+
+@pytest.mark.parametrize("timestamp", [[1], {"at": 1}, True, False])
+def test_timestamp_of_wrong_type_is_rejected(timestamp):
+    bulk_import = BulkImport("ndjson")
+    bulk_import.feed(json.dumps({"type": "registration", "user": 1, "timestamp": timestamp}))
+    assert bulk_import.rejected == 1
+    assert bulk_import.errors[0]["line"] == 1
+    assert not bulk_import.ready()
+
+
+def test_numeric_timestamp_is_accepted():
+    bulk_import = BulkImport("ndjson")
+    bulk_import.feed(json.dumps({"type": "registration", "user": 1, "timestamp": 1700000000}))
+    assert bulk_import.rejected == 0